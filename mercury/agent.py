@@ -0,0 +1,152 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import List, Tuple
+
+import docker
+
+from mercury.constants import (
+    CONTAINER_AGENT_CALL_TIMEOUT,
+    CONTAINER_AGENT_RESTART_INTERVAL,
+)
+from mercury.docker_client import run_docker_call
+from mercury.payload import KERNEL_HELPERS_HOST_DIR, KERNEL_HELPERS_CONTAINER_DIR
+
+logger = logging.getLogger(__name__)
+
+AGENT_SCRIPT = f"{KERNEL_HELPERS_CONTAINER_DIR}/mercury_agent.py"
+AGENT_SOCKETS_DIR = "agents"
+# command output is sent back as a single json line
+AGENT_READ_LIMIT = 256 * 1024 * 1024
+
+
+class AgentUnavailable(Exception):
+    """The agent of a container cannot be reached, nothing was sent to it"""
+
+
+def get_agent_socket_path(container_id: str, in_container: bool = False) -> str:
+    # unix socket paths are limited to about a hundred characters
+    socket_name = f"{container_id[:12]}.sock"
+    if in_container:
+        return f"{KERNEL_HELPERS_CONTAINER_DIR}/{AGENT_SOCKETS_DIR}/{socket_name}"
+    return os.path.join(KERNEL_HELPERS_HOST_DIR, AGENT_SOCKETS_DIR, socket_name)
+
+
+async def start_agent(container: docker.models.containers.Container) -> None:
+    """Start the agent of a running container in the background"""
+    socket_path = get_agent_socket_path(container.id, in_container=True)
+    # only the orchestrator's user may connect to the socket
+    owner = f"{os.getuid()}:{os.getgid()}"
+    await run_docker_call(
+        container.exec_run,
+        f"python3 {AGENT_SCRIPT} --socket {socket_path} --owner {owner}",
+        detach=True,
+    )
+
+
+def remove_agent_socket(container_id: str) -> None:
+    """Remove the socket of the agent of a container that is killed or removed"""
+    try:
+        os.remove(get_agent_socket_path(container_id))
+    except FileNotFoundError:
+        pass
+
+
+class AgentClient:
+    """Connection to the agent running `container.cli` commands in a container
+
+    The connection is opened on the first call and kept for the following ones,
+    calls are sent one at a time. When the agent cannot be reached the call
+    raises AgentUnavailable, so that the caller can use `docker exec` instead,
+    and the agent is started again unless that was tried recently. When a
+    `timeout` is set, a command that does not answer in time fails and the
+    following ones go through `docker exec` until the container restarts.
+    """
+
+    def __init__(
+        self,
+        container: docker.models.containers.Container,
+        timeout: float = CONTAINER_AGENT_CALL_TIMEOUT,
+    ):
+        self._container = container
+        self._timeout = timeout
+        self._socket_path = get_agent_socket_path(container.id)
+        self._reader: asyncio.StreamReader = None
+        self._writer: asyncio.StreamWriter = None
+        # created on first use, so that it belongs to the running event loop
+        self._lock: asyncio.Lock = None
+        # agents are started along with their container
+        self._started_at = time.monotonic()
+        # a command timed out, the agent may be busy with it until a restart
+        self._stalled = False
+
+    async def call(self, argv: List[str]) -> Tuple[int, bytes]:
+        """Run the cli with the given arguments, return its exit code and output"""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self._stalled:
+                raise AgentUnavailable("a previous command timed out")
+            if self._writer is not None and self._reader.at_eof():
+                # the agent went away since the last call, e.g. on a restart
+                self.close()
+            if self._writer is None:
+                await self._connect()
+
+            request = json.dumps({"argv": argv}).encode("utf-8") + b"\n"
+            try:
+                response = await asyncio.wait_for(
+                    self._send(request), timeout=self._timeout
+                )
+            except asyncio.TimeoutError:
+                # later calls must not wait behind a command that hangs, nor
+                # read its response if it ever comes
+                logger.error(
+                    f"Agent {self._socket_path} did not answer in {self._timeout}s"
+                )
+                self.close()
+                self._stalled = True
+                return 1, f"agent call timed out after {self._timeout}s".encode("utf-8")
+            except (
+                OSError,
+                asyncio.IncompleteReadError,
+                asyncio.LimitOverrunError,
+                ValueError,
+            ) as e:
+                # the command may have run, it must not be sent again
+                logger.error(f"Lost the connection to agent {self._socket_path}: {e}")
+                self.close()
+                return 1, f"agent connection lost: {e}".encode("utf-8")
+
+        return response["exit_code"], response["output"].encode("utf-8")
+
+    async def _send(self, request: bytes) -> dict:
+        self._writer.write(request)
+        await self._writer.drain()
+        return json.loads(await self._reader.readuntil(b"\n"))
+
+    async def _connect(self) -> None:
+        try:
+            self._reader, self._writer = await asyncio.open_unix_connection(
+                self._socket_path, limit=AGENT_READ_LIMIT
+            )
+        except OSError as e:
+            if time.monotonic() - self._started_at > CONTAINER_AGENT_RESTART_INTERVAL:
+                logger.info(f"Starting the agent of container {self._container.id}")
+                self._started_at = time.monotonic()
+                await start_agent(self._container)
+            raise AgentUnavailable(str(e)) from e
+
+    def restarted(self) -> None:
+        """The container restarted, the agent has to be started again"""
+        self.close()
+        self._stalled = False
+        self._started_at = time.monotonic()
+
+    def close(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = None
+        self._writer = None
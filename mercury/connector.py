@@ -0,0 +1,53 @@
+import logging
+from typing import Dict, List, Tuple
+
+from mercury.edge import MercuryEdge
+
+logger = logging.getLogger(__name__)
+
+
+class MercuryConnectorRegistry:
+    """Maps connector ids to the edge and source-destination mapping they belong to
+
+    Connectors live in the `source_dest_connect` list of their edge, the registry
+    keeps an index over all of them so they can be found without walking the
+    edges of the workflow.
+    """
+
+    def __init__(self):
+        self._connectors: Dict[str, Tuple[MercuryEdge, dict]] = {}
+
+    def __len__(self) -> int:
+        return len(self._connectors)
+
+    def __contains__(self, connector_id: str) -> bool:
+        return connector_id in self._connectors
+
+    @property
+    def connector_ids(self) -> List[str]:
+        return list(self._connectors.keys())
+
+    def get(self, connector_id: str) -> Tuple[MercuryEdge, dict]:
+        return self._connectors.get(connector_id, (None, None))
+
+    def add(self, edge: MercuryEdge, source_dest_map: dict) -> None:
+        connector_id = source_dest_map["connector_id"]
+        assert connector_id not in self._connectors, "connector id already exists"
+
+        if source_dest_map not in edge.source_dest_connect:
+            edge.source_dest_connect.append(source_dest_map)
+        self._connectors[connector_id] = (edge, source_dest_map)
+
+    def remove(self, connector_id: str) -> Tuple[MercuryEdge, dict]:
+        edge, source_dest_map = self._connectors.pop(connector_id)
+        edge.source_dest_connect.remove(source_dest_map)
+        return edge, source_dest_map
+
+    def add_edge(self, edge: MercuryEdge) -> None:
+        for source_dest_map in edge.source_dest_connect:
+            self.add(edge, source_dest_map)
+
+    def remove_edge(self, edge: MercuryEdge) -> None:
+        # the edge keeps its mappings, they are only dropped from the index
+        for source_dest_map in edge.source_dest_connect:
+            self._connectors.pop(source_dest_map["connector_id"], None)
@@ -4,3 +4,96 @@ DOCKER_COMMON_VOLUME = os.path.abspath("mercury/experimentation/common_volume")
 BASE_DOCKER_IMAGE_NAME = "jupyter-mercury"
 BASE_DOCKER_BIND_VOLUME = "/usr/src/app"
 DEFAULT_DOCKER_VOL_MODE = "rw"
+# directory in the common volume holding modules imported by generated snippets
+KERNEL_HELPERS_DIR = ".mercury"
+MERCURY_NODE_LABEL = "mercury.node"
+
+# host ports that the jupyter servers of node containers are mapped to
+JUPYTER_PORT_RANGE_START = int(os.environ.get("MERCURY_JUPYTER_PORT_START", 8880))
+JUPYTER_PORT_RANGE_END = int(os.environ.get("MERCURY_JUPYTER_PORT_END", 8999))
+
+# number of docker-py calls that can be in flight at the same time
+DOCKER_MAX_WORKERS = int(os.environ.get("MERCURY_DOCKER_MAX_WORKERS", 8))
+
+# seconds for which container states fetched from docker are considered fresh
+CONTAINER_STATE_MAX_AGE = float(os.environ.get("MERCURY_CONTAINER_STATE_MAX_AGE", 2))
+
+# idle containers kept running so that new nodes do not wait for jupyter to start,
+# the pool grows with the number of nodes created within the rate window (seconds)
+WARM_POOL_MIN_SIZE = int(os.environ.get("MERCURY_WARM_POOL_MIN_SIZE", 1))
+WARM_POOL_MAX_SIZE = int(os.environ.get("MERCURY_WARM_POOL_MAX_SIZE", 4))
+WARM_POOL_RATE_WINDOW = float(os.environ.get("MERCURY_WARM_POOL_RATE_WINDOW", 300))
+
+# bytes of generated code snippets kept in memory between requests
+SNIPPET_CACHE_MAX_BYTES = int(
+    os.environ.get("MERCURY_SNIPPET_CACHE_MAX_BYTES", 16 * 1024 * 1024)
+)
+
+# notebook executed for a node in workflow runs, relative to the container workdir
+NOTEBOOK_PATH = "work/scripts/Untitled.ipynb"
+
+# local state of the orchestrator that outlives a server process
+MERCURY_DATA_DIR = os.path.expanduser(
+    os.environ.get("MERCURY_DATA_DIR", os.path.join("~", ".mercury"))
+)
+
+# outputs of successful node executions, reused when a node's inputs are unchanged
+EXECUTION_MEMO_MAX_BYTES = int(
+    os.environ.get("MERCURY_EXECUTION_MEMO_MAX_BYTES", 2 * 1024**3)
+)
+EXECUTION_MEMO_MAX_AGE = float(
+    os.environ.get("MERCURY_EXECUTION_MEMO_MAX_AGE", 7 * 24 * 3600)
+)
+
+# finished workflow runs whose status is kept in memory
+MAX_WORKFLOW_RUNS_KEPT = int(os.environ.get("MERCURY_MAX_WORKFLOW_RUNS_KEPT", 50))
+
+# seconds assumed for nodes without a recorded execution when planning runs
+DEFAULT_NODE_DURATION = float(os.environ.get("MERCURY_DEFAULT_NODE_DURATION", 60))
+
+# seconds a node's notebook run may take, unset for no limit
+NODE_TIMEOUT = (
+    float(os.environ["MERCURY_NODE_TIMEOUT"])
+    if os.environ.get("MERCURY_NODE_TIMEOUT")
+    else None
+)
+# seconds a stopped notebook run has to exit before its container is restarted
+NODE_STOP_GRACE_PERIOD = float(os.environ.get("MERCURY_NODE_STOP_GRACE_PERIOD", 10))
+# seconds before the first retry of a failed node, doubled on every further retry
+NODE_RETRY_BACKOFF = float(os.environ.get("MERCURY_NODE_RETRY_BACKOFF", 5))
+
+# commands are sent to an agent in each container instead of a new docker exec
+USE_CONTAINER_AGENT = os.environ.get("MERCURY_USE_CONTAINER_AGENT", "1") == "1"
+# seconds between attempts to start an agent that cannot be reached
+CONTAINER_AGENT_RESTART_INTERVAL = float(
+    os.environ.get("MERCURY_CONTAINER_AGENT_RESTART_INTERVAL", 30)
+)
+# seconds a command sent to an agent may take before its connection is dropped,
+# no limit by default as commands run user code, e.g. the code of a node
+CONTAINER_AGENT_CALL_TIMEOUT = (
+    float(os.environ["MERCURY_CONTAINER_AGENT_CALL_TIMEOUT"])
+    if os.environ.get("MERCURY_CONTAINER_AGENT_CALL_TIMEOUT")
+    else None
+)
+
+# binary edge payloads are kept in a shared memory directory mounted into every
+# node container, payloads larger than SHM_PAYLOAD_MAX_BYTES spill to the disk
+SHM_TRANSPORT = os.environ.get("MERCURY_SHM_TRANSPORT", "0") == "1"
+SHM_HOST_DIR = os.environ.get("MERCURY_SHM_DIR", "/dev/shm/mercury")
+SHM_CONTAINER_DIR = "/mercury/shm"
+SHM_PAYLOAD_MAX_BYTES = int(
+    os.environ.get("MERCURY_SHM_PAYLOAD_MAX_BYTES", 512 * 1024 * 1024)
+)
+
+# blobs of binary payloads written to the common volume are compressed with the
+# first of these codecs the source kernel can import, e.g. "zstd,lz4,zlib", when
+# they have at least PAYLOAD_COMPRESS_MIN_BYTES and compress well. The codecs
+# have to be importable by the destination kernels too, an empty list disables it
+PAYLOAD_COMPRESSION_CODECS = [
+    _
+    for _ in os.environ.get("MERCURY_PAYLOAD_COMPRESSION_CODECS", "zlib").split(",")
+    if _
+]
+PAYLOAD_COMPRESS_MIN_BYTES = int(
+    os.environ.get("MERCURY_PAYLOAD_COMPRESS_MIN_BYTES", 1024 * 1024)
+)
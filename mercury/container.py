@@ -1,9 +1,88 @@
+import asyncio
 import docker
 import logging
+import shlex
+import time
+from typing import Dict
+
+from mercury.docker_client import docker_cl, run_docker_call
+from mercury.constants import (
+    CONTAINER_STATE_MAX_AGE,
+    MERCURY_NODE_LABEL,
+    USE_CONTAINER_AGENT,
+)
+from mercury.agent import (
+    AgentClient,
+    AgentUnavailable,
+    remove_agent_socket,
+    start_agent,
+)
+from mercury.resources import get_docker_limits
 
 logger = logging.getLogger(__name__)
 
 
+class ContainerStateCache:
+    """States of all Mercury containers, fetched from docker with a single call
+
+    States are refetched for all containers at once when they are older than
+    `max_age` seconds, instead of reloading every container on its own.
+    """
+
+    def __init__(self, max_age: float = CONTAINER_STATE_MAX_AGE):
+        self._max_age = max_age
+        self._states: Dict[str, dict] = {}
+        self._refreshed_at: float = None
+
+    @property
+    def is_stale(self) -> bool:
+        return (
+            self._refreshed_at is None
+            or time.monotonic() - self._refreshed_at > self._max_age
+        )
+
+    def refresh(self) -> None:
+        containers = docker_cl.api.containers(
+            all=True, filters={"label": MERCURY_NODE_LABEL}
+        )
+        self._states = {
+            _["Id"]: {"Status": _["State"], "Running": _["State"] == "running"}
+            for _ in containers
+        }
+        self._refreshed_at = time.monotonic()
+        logger.debug(f"Refreshed state of {len(self._states)} containers")
+
+    async def ensure_fresh(self, *container_ids: str) -> None:
+        """Refresh stale states without blocking the event loop
+
+        States are also refreshed when one of the given containers is unknown,
+        it could have been started after the last refresh.
+        """
+        if self.is_stale or any(_ not in self._states for _ in container_ids):
+            await run_docker_call(self.refresh)
+            for container_id in container_ids:
+                self._states.setdefault(
+                    container_id, {"Status": "removed", "Running": False}
+                )
+
+    def get(self, container_id: str) -> dict:
+        """The cached state, call ensure_fresh first for an up to date one"""
+        return self._states.get(container_id, {"Status": "unknown", "Running": False})
+
+    def get_cached(self, container_id: str) -> dict:
+        """The last known state, without asking docker even if it is stale"""
+        return self._states.get(container_id, {})
+
+    def update(self, container_id: str, state: dict) -> None:
+        self._states[container_id] = state
+
+    def invalidate(self) -> None:
+        self._refreshed_at = None
+
+
+container_state_cache = ContainerStateCache()
+
+
 class MercuryContainer:
     def __init__(self, container: docker.models.containers.Container):
         self._container: docker.models.containers.Container = container
@@ -14,6 +93,9 @@ class MercuryContainer:
         self._notebook_exec_exit_code: int = -1
         self._jupyter_server: bool = False
         self._notebook_exec_pid: int = None
+        # set once the notebook run reports an exit code, created per run
+        self._notebook_exec_done: asyncio.Event = None
+        self._agent = AgentClient(container) if USE_CONTAINER_AGENT else None
 
     @property
     def container(self) -> docker.models.containers.Container:
@@ -22,6 +104,8 @@ class MercuryContainer:
     @container.deleter
     def container(self):
         self._container.remove()
+        remove_agent_socket(self._container_id)
+        container_state_cache.invalidate()
         self._container = None
         self._container_state = None
         self._container_id = None
@@ -31,8 +115,16 @@ class MercuryContainer:
         if self._container is None:
             self._container_state = None
             return self._container_state
-        self._container.reload()
-        self._container_state = self._container.attrs["State"]
+        self._container_state = container_state_cache.get(self._container_id)
+        return self._container_state
+
+    def update_container_state(self, state_changes: dict) -> dict:
+        """Apply state changes learnt without asking docker, e.g. from its events"""
+        if self._container is None:
+            return None
+        current_state = container_state_cache.get_cached(self._container_id)
+        self._container_state = {**current_state, **state_changes}
+        container_state_cache.update(self._container_id, self._container_state)
         return self._container_state
 
     @property
@@ -62,6 +154,8 @@ class MercuryContainer:
     @notebook_exec_exit_code.setter
     def notebook_exec_exit_code(self, exit_code: int):
         self._notebook_exec_exit_code = exit_code
+        if exit_code != -1 and self._notebook_exec_done is not None:
+            self._notebook_exec_done.set()
 
     @property
     def notebook_exec_pid(self) -> int:
@@ -71,6 +165,27 @@ class MercuryContainer:
     def notebook_exec_pid(self, pid: int):
         self._notebook_exec_pid = pid
 
+    def reset_notebook_exec(self) -> None:
+        """Prepare for a new notebook run, must be called on the event loop"""
+        self._notebook_exec_exit_code = -1
+        self._notebook_exec_pid = None
+        self._notebook_exec_done = asyncio.Event()
+
+    def container_exited(self) -> None:
+        """The container exited, e.g. was oom killed, its notebook run failed"""
+        done = self._notebook_exec_done
+        if done is not None and not done.is_set():
+            logger.warning(
+                f"Container {self._container_id} exited during a notebook run"
+            )
+            self.notebook_exec_exit_code = 1
+
+    async def wait_for_notebook_exec(self, timeout: float = None) -> int:
+        """Wait until the notebook run reports its exit code and return it"""
+        assert self._notebook_exec_done, "notebook run was not reset before waiting"
+        await asyncio.wait_for(self._notebook_exec_done.wait(), timeout)
+        return self._notebook_exec_exit_code
+
     @property
     def jupyter_server(self) -> bool:
         return self._jupyter_server
@@ -79,7 +194,7 @@ class MercuryContainer:
     def jupyter_server(self, jupyter_server_state: bool):
         self._jupyter_server = jupyter_server_state
 
-    def commit(
+    async def commit(
         self,
         build_img_name: str = None,
         build_img_tag: str = "latest",
@@ -93,34 +208,53 @@ class MercuryContainer:
         if self._container is None:
             logger.error("This node does not have an attached container")
 
+        await container_state_cache.ensure_fresh(self._container_id)
         assert self.container_state["Running"]
-        self._container.commit(repository=build_img_name, tag=build_img_tag)
+        await run_docker_call(
+            self._container.commit, repository=build_img_name, tag=build_img_tag
+        )
 
-    def execute_code(self, code: str) -> tuple:
-        logger.info("Executing code in docker container")
-        logger.info(code)
+    async def exec_run(self, cmd: str, **kwargs) -> tuple:
+        return await run_docker_call(self._container.exec_run, cmd, **kwargs)
 
-        cmd = f"python3 -m container.cli execute-code --code '{code}'"
+    async def exec_cli(self, *args: str) -> tuple:
+        """Run a `container.cli` command, through the container's agent if it is up"""
+        if self._agent is not None:
+            try:
+                return await self._agent.call(list(args))
+            except AgentUnavailable as e:
+                logger.warning(f"Agent unavailable, using docker exec instead: {e}")
+
+        cmd = "python3 -m container.cli " + " ".join(shlex.quote(_) for _ in args)
         logger.info(f"Docker exec command: {cmd}")
-        exit_code, container_output = self._container.exec_run(cmd)
+        return await self.exec_run(cmd)
 
-        if exit_code != 0:
-            logger.warning("code did not run successfully in kernel")
-            print(container_output)
+    async def update_resources(self, cpus: float = None, memory: int = None) -> None:
+        limits = get_docker_limits(cpus, memory)
+        if limits:
+            await run_docker_call(self._container.update, **limits)
 
-        return exit_code, container_output
+    async def restart(self) -> None:
+        await run_docker_call(self._container.restart)
+        container_state_cache.invalidate()
+        if self._agent is not None:
+            self._agent.restarted()
+            await start_agent(self._container)
 
-    def write_variables_to_json(
-        self, source_outputs: list, dest_inputs: list, json_fp: str
-    ) -> tuple:
-        logger.info("Writing variables from docker environment")
+    async def kill(self) -> None:
+        await run_docker_call(self._container.kill)
+        if self._agent is not None:
+            self._agent.close()
+        remove_agent_socket(self._container_id)
+        container_state_cache.invalidate()
 
-        source_outputs_list = "|".join(source_outputs)
-        dest_inputs_list = "|".join(dest_inputs)
-        cmd = f"python3 -m container.cli write-kernel-variables-to-json --source_outputs '{source_outputs_list}' --dest_inputs '{dest_inputs_list}'  --json '{json_fp}'"
-        logger.info(f"Docker exec command: {cmd}")
+    async def execute_code(self, code: str) -> tuple:
+        logger.info("Executing code in docker container")
+        logger.info(code)
 
-        exit_code, container_output = self._container.exec_run(cmd)
+        exit_code, container_output = await self.exec_cli(
+            "execute-code", "--code", code
+        )
 
         if exit_code != 0:
             logger.warning("code did not run successfully in kernel")
@@ -1,104 +1,197 @@
+import asyncio
 import networkx as nx
+import heapq
 import logging
-from typing import List, Dict
+from collections import OrderedDict
+from itertools import count
+from typing import Callable, Iterable, List, Dict, Set, Tuple
 from uuid import uuid4
 
-from networkx.algorithms.dag import ancestors
-
 from mercury.node import MercuryNode
 from mercury.edge import MercuryEdge
+from mercury.connector import MercuryConnectorRegistry
+from mercury.reachability import ReachabilityIndex
+from mercury.ports import PortAllocator
+from mercury.snippet_cache import snippet_cache
+from mercury.memo import ExecutionMemo
+from mercury.run import WorkflowRun, RUN_STATE_FAILED, RUN_STATE_STOPPED
+from mercury.history import RunHistory
+from mercury.payload import get_payload_size
+from mercury.resources import get_host_capacity
+from mercury.planner import get_upward_ranks, plan_schedule
+from mercury.constants import MAX_WORKFLOW_RUNS_KEPT, DEFAULT_NODE_DURATION
 
 logger = logging.getLogger(__name__)
 
+# which nodes a workflow run executes, relative to the node ids it is given
+RUN_MODE_ALL = "all"
+RUN_MODE_FROM = "from"
+RUN_MODE_TO = "to"
+RUN_MODE_SUBSET = "subset"
+RUN_MODES = (RUN_MODE_ALL, RUN_MODE_FROM, RUN_MODE_TO, RUN_MODE_SUBSET)
+# runs continuing a failed run, with the nodes that run did not complete
+RUN_MODE_RESUME = "resume"
+
 
 class MercuryDag:
     def __init__(self):
         self.id = uuid4().hex
         self._nxdag = nx.DiGraph()
         self._state: str = None
+        self._stop_requested: asyncio.Event = None
+
+        # indexes kept in sync with the graph so that lookups do not scan it
+        self._nodes_by_id: Dict[str, MercuryNode] = {}
+        self._edges_by_id: Dict[str, MercuryEdge] = {}
+        self._edges_by_nodes: Dict[Tuple[str, str], MercuryEdge] = {}
+        self._in_edges: Dict[str, Dict[str, MercuryEdge]] = {}
+        self._out_edges: Dict[str, Dict[str, MercuryEdge]] = {}
+        self._connectors = MercuryConnectorRegistry()
+        self._reachability = ReachabilityIndex()
+        self._port_allocator = PortAllocator()
+        self._execution_memo = ExecutionMemo()
+
+        self._runs: "OrderedDict[str, WorkflowRun]" = OrderedDict()
+        self._run_listeners: List[Callable[[dict], None]] = []
+        self._run_task: asyncio.Future = None
+        self._run_history = RunHistory()
 
     @property
     def nodes(self) -> List[MercuryNode]:
         return list(self._nxdag.nodes)
 
     @property
-    def edges(self) -> list:
-        return [_[2]["object"] for _ in self._nxdag.edges(data=True)]
+    def edges(self) -> List[MercuryEdge]:
+        return list(self._edges_by_id.values())
 
-    def add_node(self, node: MercuryNode) -> None:
+    @property
+    def connectors(self) -> MercuryConnectorRegistry:
+        return self._connectors
+
+    def reserve_jupyter_port(self) -> int:
+        return self._port_allocator.allocate()
+
+    def reserve_jupyter_ports(self, n_ports: int) -> List[int]:
+        return self._port_allocator.reserve(n_ports)
 
-        if len(self._nxdag.nodes) > 0:
-            used_ports = [_.jupyter_port for _ in self._nxdag.nodes]
-            print(used_ports)
-            port = max(used_ports) + 1
-            logger.info(f"Starting new container and mapping to port {port}")
-            node.jupyter_port = port
+    def release_jupyter_port(self, port: int) -> None:
+        self._port_allocator.release(port)
+
+    def add_node(self, node: MercuryNode) -> None:
+        # nodes with a pooled container already come with their port
+        if node.jupyter_port is None:
+            node.jupyter_port = self.reserve_jupyter_port()
+            logger.info(f"Mapping container of new node to port {node.jupyter_port}")
         self._nxdag.add_node(node, id=node.id)
+        self._nodes_by_id[node.id] = node
+        self._in_edges[node.id] = {}
+        self._out_edges[node.id] = {}
+        self._reachability.add_node(node.id)
 
     def remove_node(self, node: MercuryNode) -> None:
+        # networkx drops the edges of a removed node, so drop them from the
+        # indexes as well
+        for edge in self.get_node_edges(node.id):
+            self._unindex_edge(edge)
         self._nxdag.remove_node(node)
+        del self._nodes_by_id[node.id]
+        del self._in_edges[node.id]
+        del self._out_edges[node.id]
+        self._reachability.remove_node(node.id)
+        self.release_jupyter_port(node.jupyter_port)
+        snippet_cache.invalidate(node.id)
 
     def add_edge(self, edge: MercuryEdge) -> None:
         # not the most elegant, to do: change
         assert edge.source_node
         assert edge.dest_node
+        assert not self._reachability.creates_cycle(
+            edge.source_node.id, edge.dest_node.id
+        ), "This edge would create a cycle in the workflow"
 
         self._nxdag.add_edge(edge.source_node, edge.dest_node, object=edge)
+        self._edges_by_id[edge.id] = edge
+        self._edges_by_nodes[(edge.source_node.id, edge.dest_node.id)] = edge
+        self._out_edges[edge.source_node.id][edge.id] = edge
+        self._in_edges[edge.dest_node.id][edge.id] = edge
+        self._connectors.add_edge(edge)
+        self._reachability.add_edge(edge.source_node.id, edge.dest_node.id)
 
     def remove_edge(self, edge: MercuryEdge) -> None:
         assert edge.source_node
         assert edge.dest_node
         self._nxdag.remove_edge(edge.source_node, edge.dest_node)
+        self._unindex_edge(edge)
+
+    def _unindex_edge(self, edge: MercuryEdge) -> None:
+        del self._edges_by_id[edge.id]
+        del self._edges_by_nodes[(edge.source_node.id, edge.dest_node.id)]
+        del self._out_edges[edge.source_node.id][edge.id]
+        del self._in_edges[edge.dest_node.id][edge.id]
+        self._connectors.remove_edge(edge)
+        self._reachability.remove_edge(edge.source_node.id, edge.dest_node.id)
+        self._invalidate_snippets(edge)
+        edge.remove_shm_payload()
+
+    def _invalidate_snippets(self, edge: MercuryEdge) -> None:
+        snippet_cache.invalidate(edge.id)
+        snippet_cache.invalidate(edge.source_node.id)
+        snippet_cache.invalidate(edge.dest_node.id)
+
+    def add_connector(self, edge: MercuryEdge, source_dest_map: dict) -> None:
+        assert self._edges_by_id.get(edge.id) is edge, "edge is not part of the dag"
+        self._connectors.add(edge, source_dest_map)
+        self._invalidate_snippets(edge)
+
+    def remove_connector(self, connector_id: str) -> Tuple[MercuryEdge, dict]:
+        """Remove a connector, and its edge once the edge has no connectors left"""
+        edge, source_dest_map = self._connectors.remove(connector_id)
+        self._invalidate_snippets(edge)
+        if len(edge.source_dest_connect) == 0:
+            self.remove_edge(edge)
+        return edge, source_dest_map
+
+    def get_connector(self, connector_id: str) -> Tuple[MercuryEdge, dict]:
+        return self._connectors.get(connector_id)
 
     def get_node(self, id: str) -> MercuryNode:
-        node_search = [_ for _ in self._nxdag.nodes if _.id == id]
-        assert len(node_search) < 2
-        if len(node_search) == 1:
-            return node_search[0]
+        return self._nodes_by_id.get(id)
 
     def get_edge(self, id: str) -> MercuryEdge:
-        edge_search = [_ for _ in self.edges if _.id == id]
-        assert len(edge_search) < 2
-        if len(edge_search) == 1:
-            return edge_search[0]
+        return self._edges_by_id.get(id)
 
     def get_edge_from_nodes(
         self, source_node_id: str, detination_node_id: str
     ) -> MercuryEdge:
-        edge_search = [
-            _
-            for _ in self.edges
-            if _.source_node.id == source_node_id
-            and _.dest_node.id == detination_node_id
-        ]
-        assert len(edge_search) < 3
-        if len(edge_search) == 1:
-            return edge_search[0]
+        return self._edges_by_nodes.get((source_node_id, detination_node_id))
 
     def get_valid_connections_for_nodes(self) -> Dict[MercuryNode, List[MercuryNode]]:
-        all_nodes = set(self._nxdag.nodes)
-        valid_edges_per_nodes = {}
-        for node in self._nxdag.nodes:
-            impossible_descendants = ancestors(self._nxdag, node)
-            impossible_descendants.add(node)
-            possible_descendants = all_nodes.difference(impossible_descendants)
-            valid_edges_per_nodes[node] = (
-                list(possible_descendants) if possible_descendants is not None else []
-            )
+        return {
+            node: [
+                self._nodes_by_id[dest_id]
+                for dest_id in self._reachability.valid_destinations(node.id)
+            ]
+            for node in self._nodes_by_id.values()
+        }
+
+    def get_node_ancestors(self, node_id: str) -> List[MercuryNode]:
+        return [self._nodes_by_id[_] for _ in self._reachability.ancestors(node_id)]
 
-        return valid_edges_per_nodes
+    def get_node_descendants(self, node_id: str) -> List[MercuryNode]:
+        return [self._nodes_by_id[_] for _ in self._reachability.descendants(node_id)]
 
     def get_node_edges(self, node_id: str) -> List[MercuryEdge]:
-        edge_search = [
-            _
-            for _ in self.edges
-            if _.source_node.id == node_id or _.dest_node.id == node_id
-        ]
-        return edge_search
+        node_edges = {
+            **self._in_edges.get(node_id, {}),
+            **self._out_edges.get(node_id, {}),
+        }
+        return list(node_edges.values())
 
     def get_node_input_edges(self, node_id: str) -> List[MercuryEdge]:
-        edge_search = [_ for _ in self.edges if _.dest_node.id == node_id]
-        return edge_search
+        return list(self._in_edges.get(node_id, {}).values())
+
+    def get_node_output_edges(self, node_id: str) -> List[MercuryEdge]:
+        return list(self._out_edges.get(node_id, {}).values())
 
     @property
     def state(self) -> str:
@@ -107,65 +200,494 @@ class MercuryDag:
     @state.setter
     def state(self, workflow_state: str) -> None:
         self._state = workflow_state
+        if workflow_state == "stop" and self._stop_requested is not None:
+            self._stop_requested.set()
+
+    def get_run_nodes(
+        self, run_mode: str = RUN_MODE_ALL, node_ids: Iterable[str] = None
+    ) -> Set[MercuryNode]:
+        """Nodes executed by a run in the given mode
+
+        "from" runs the given nodes and everything downstream of them, "to" runs the
+        given nodes and everything upstream of them, "subset" runs only the given
+        nodes and "all" runs the whole workflow.
+        """
+        assert run_mode in RUN_MODES
+        if run_mode == RUN_MODE_ALL:
+            return set(self._nodes_by_id.values())
+
+        assert node_ids, f"run mode {run_mode} needs node ids"
+        run_nodes = set()
+        for node_id in node_ids:
+            node = self.get_node(node_id)
+            assert node, f"node {node_id} does not exist"
+            run_nodes.add(node)
+            if run_mode == RUN_MODE_FROM:
+                run_nodes.update(self.get_node_descendants(node_id))
+            elif run_mode == RUN_MODE_TO:
+                run_nodes.update(self.get_node_ancestors(node_id))
+        return run_nodes
+
+    def add_run_listener(self, listener: Callable[[dict], None]) -> None:
+        """Receive the events of all runs of this workflow started from now on"""
+        self._run_listeners.append(listener)
+
+    @property
+    def runs(self) -> List[WorkflowRun]:
+        return list(self._runs.values())
+
+    @property
+    def active_run(self) -> WorkflowRun:
+        for run in reversed(self._runs.values()):
+            if not run.is_finished:
+                return run
+        return None
+
+    def get_run(self, run_id: str) -> WorkflowRun:
+        return self._runs.get(run_id)
+
+    def start_run(
+        self,
+        run_mode: str = RUN_MODE_ALL,
+        node_ids: Iterable[str] = None,
+        use_memo: bool = True,
+        n_max_parallel: int = 2,
+        timeout: float = None,
+    ) -> WorkflowRun:
+        """Start a workflow run in the background and return it right away"""
+        assert self.active_run is None, "A workflow run is already in progress"
+        run_nodes = self.get_run_nodes(run_mode, node_ids)
+        return self._start_run(run_mode, run_nodes, use_memo, n_max_parallel, timeout)
+
+    def resume_run(
+        self,
+        run_id: str = None,
+        use_memo: bool = True,
+        n_max_parallel: int = 2,
+        timeout: float = None,
+    ) -> WorkflowRun:
+        """Start a run of the nodes that a failed or stopped run did not complete
+
+        Completed nodes are skipped as long as the payloads on their output
+        edges are the ones recorded when they completed, and none of the nodes
+        upstream of them is run again. Without a run id, the latest run is
+        resumed.
+        """
+        assert self.active_run is None, "A workflow run is already in progress"
+        if run_id is None:
+            assert self._runs, "There is no workflow run to resume"
+            run_id = next(reversed(self._runs))
+        failed_run = self.get_run(run_id)
+        assert failed_run is not None, f"Run {run_id} does not exist"
+        assert failed_run.state in (RUN_STATE_FAILED, RUN_STATE_STOPPED)
+
+        run_nodes = set()
+        for node_id in failed_run.node_runs:
+            node = self.get_node(node_id)
+            if node is None:
+                continue
+            payload_stamps = {
+                edge.id: edge.get_payload_stamp()
+                for edge in self.get_node_output_edges(node_id)
+            }
+            if failed_run.checkpoints.get(node_id) != payload_stamps:
+                run_nodes.add(node)
+        # the outputs of nodes downstream of a re-run node are stale, even if
+        # they completed
+        for node in list(run_nodes):
+            run_nodes.update(
+                _
+                for _ in self.get_node_descendants(node.id)
+                if _.id in failed_run.node_runs
+            )
+        logger.info(
+            f"Resuming run {run_id}, {len(failed_run.node_runs) - len(run_nodes)} "
+            "nodes are already complete"
+        )
+        return self._start_run(
+            RUN_MODE_RESUME,
+            run_nodes,
+            use_memo,
+            n_max_parallel,
+            timeout,
+            resumed_from=run_id,
+        )
+
+    def _start_run(
+        self,
+        run_mode: str,
+        run_nodes: Set[MercuryNode],
+        use_memo: bool,
+        n_max_parallel: int,
+        timeout: float,
+        resumed_from: str = None,
+    ) -> WorkflowRun:
+        run = WorkflowRun(
+            self.id,
+            [_.id for _ in run_nodes],
+            run_mode,
+            self._run_listeners,
+            edges=self._get_run_edges(run_nodes),
+            resumed_from=resumed_from,
+        )
+        self._runs[run.id] = run
+        while len(self._runs) > MAX_WORKFLOW_RUNS_KEPT:
+            self._runs.popitem(last=False)
+
+        self._state = "running"
+        # created before the run is scheduled so that a stop requested while it
+        # prepares, e.g. reads the run history, is not lost
+        self._stop_requested = asyncio.Event()
+        self._run_task = asyncio.ensure_future(
+            self._execute_run(run, run_nodes, use_memo, n_max_parallel, timeout)
+        )
+        return run
+
+    async def _execute_run(
+        self,
+        run: WorkflowRun,
+        run_nodes: Set[MercuryNode],
+        use_memo: bool,
+        n_max_parallel: int,
+        timeout: float,
+    ) -> None:
+        run.started()
+        try:
+            exit_code = await self.run_dag(
+                n_max_parallel=n_max_parallel,
+                use_memo=use_memo,
+                run_nodes=run_nodes,
+                run=run,
+                timeout=timeout,
+            )
+        except Exception:
+            logger.exception(f"Workflow run {run.id} failed")
+            exit_code = 1
+
+        run.finished(exit_code, stopped=self._state == "stop")
+        self._state = None
+
+        try:
+            await self._run_history.record(run)
+        except Exception:
+            logger.exception(f"Could not record workflow run {run.id} in the history")
+
+    @property
+    def run_history(self) -> RunHistory:
+        return self._run_history
+
+    def _get_run_edges(self, run_nodes: Set[MercuryNode]) -> List[Tuple[str, str]]:
+        return [
+            (edge.source_node.id, edge.dest_node.id)
+            for edge in self.edges
+            if edge.source_node in run_nodes and edge.dest_node in run_nodes
+        ]
 
-    async def run_dag(self, n_max_parallel: int = 2):
+    async def get_node_durations(
+        self, nodes: Iterable[MercuryNode]
+    ) -> Dict[str, float]:
+        """Expected duration of each node, from the history of previous runs"""
+        node_ids = [_.id for _ in nodes]
+        try:
+            durations = await self._run_history.get_mean_durations(node_ids)
+        except Exception:
+            logger.exception("Could not read node durations from the run history")
+            durations = {}
+        return {_: durations.get(_, DEFAULT_NODE_DURATION) for _ in node_ids}
+
+    async def plan_run(
+        self,
+        run_mode: str = RUN_MODE_ALL,
+        node_ids: Iterable[str] = None,
+        n_max_parallel: int = 2,
+    ) -> dict:
+        """Predicted schedule and makespan of a run, without executing anything"""
+        run_nodes = self.get_run_nodes(run_mode, node_ids)
+        durations = await self.get_node_durations(run_nodes)
+        return plan_schedule(durations, self._get_run_edges(run_nodes), n_max_parallel)
+
+    async def run_dag(
+        self,
+        n_max_parallel: int = 2,
+        use_memo: bool = True,
+        run_nodes: Set[MercuryNode] = None,
+        run: WorkflowRun = None,
+        timeout: float = None,
+    ):
+        assert n_max_parallel > 0
+        assert timeout is None or timeout > 0
+        if run_nodes is None:
+            run_nodes = set(self._nodes_by_id.values())
+        if run is None:
+            run = WorkflowRun(self.id, [_.id for _ in run_nodes], RUN_MODE_ALL)
+            self._stop_requested = asyncio.Event()
+
+        # a node becomes ready once all of its source nodes in the run have
+        # executed, inputs from nodes outside the run use their existing payloads
+        in_degree = {}
+        for node in run_nodes:
+            in_degree[node] = 0
+            for edge in self.get_node_input_edges(node.id):
+                if edge.source_node in run_nodes:
+                    in_degree[node] += 1
+                elif edge.get_payload_stamp() is None:
+                    logger.warning(
+                        f"Node {node.id} has no payload from {edge.source_node.id}, "
+                        "which is not part of this run"
+                    )
 
+        # ready nodes are dispatched longest remaining path first, estimated
+        # from the durations recorded in previous runs
+        ranks = get_upward_ranks(
+            await self.get_node_durations(run_nodes), self._get_run_edges(run_nodes)
+        )
+        order = count()
+        ready = []
+
+        def queue_node(node: MercuryNode) -> None:
+            heapq.heappush(ready, (-ranks[node.id], next(order), node))
+            run.node_queued(node.id)
+
+        for node, degree in in_degree.items():
+            if degree == 0:
+                queue_node(node)
+
+        # nodes are only dispatched while their cpu and memory requests fit in
+        # what the host has left, smaller nodes can go ahead of one that does not
+        host_capacity = await get_host_capacity()
+        running = {}
+        memo_keys = {}
         nodes_executed = []
-        # use brute force to find a node ready for execution
-        node_to_execute = True
-        while node_to_execute:
-            node_to_execute = False
-            for node in self._nxdag.nodes:
-                if node.id in nodes_executed:
+
+        def release_successors(node: MercuryNode) -> None:
+            for successor in self._nxdag.successors(node):
+                if successor not in in_degree:
                     continue
+                in_degree[successor] -= 1
+                if in_degree[successor] == 0:
+                    queue_node(successor)
+
+        if self._state == "stop":
+            logger.info("Workflow run stopped before any node was dispatched")
+            for _, _, node in ready:
+                run.node_stopped(node.id)
+            return 1
+
+        # stop requests and notebook exit codes are signalled through events
+        # rather than polled for, so successors are dispatched immediately
+        stop_requested = asyncio.ensure_future(self._stop_requested.wait())
+        loop = asyncio.get_event_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+
+        # failed nodes with retries left wait for their backoff to pass
+        backoffs: Dict[asyncio.Future, MercuryNode] = {}
+        n_retries = {node: 0 for node in run_nodes}
+
+        def checkpoint(node: MercuryNode) -> None:
+            run.checkpoint(
+                node.id,
+                {
+                    edge.id: edge.get_payload_stamp()
+                    for edge in self.get_node_output_edges(node.id)
+                },
+            )
 
-                if not node.input:
-                    logger.info("executing node with no inputs")
-                    node_to_execute = node
-                    break
-
-                input_edges = self.get_node_input_edges(node.id)
-                if all(
-                    [
-                        input_edge.source_node.id in nodes_executed
-                        for input_edge in input_edges
-                    ]
-                ):
-                    node_to_execute = node
-                    break
-
-            if node_to_execute:
-                logger.info(f"Executing node: {node_to_execute.id}")
-
-                node_to_execute.run()
-                import asyncio
-
-                node_to_execute.mercury_container.notebook_exec_exit_code = -1
-                while True:
-                    # await here to send kernel status message, and receive stop signals
-                    await asyncio.sleep(1)
-                    logger.info(f"dag state : {self._state}")
-                    if self._state == "stop":
-                        logger.info(
-                            "Stopping workflow run. Sending stop signal to running node"
+        # the node being dispatched, if dispatching it raises the run fails
+        dispatching = None
+        try:
+            while ready or running or backoffs:
+                deferred = []
+                while ready and len(running) < n_max_parallel:
+                    queued = heapq.heappop(ready)
+                    node = queued[2]
+                    if not host_capacity.acquire(node.id, node.cpus, node.memory):
+                        deferred.append(queued)
+                        continue
+                    dispatching = node
+
+                    if not node.mercury_container:
+                        await node.initialise_container()
+
+                    memo_key = None
+                    if use_memo:
+                        memo_key = await self._execution_memo.get_key(
+                            node,
+                            self.get_node_input_edges(node.id),
+                            self.get_node_output_edges(node.id),
                         )
-                        node_stop_exit_code, _ = node_to_execute.stop()
-                        logger.info(f"Node stop exit code: {node_stop_exit_code}")
+                    if memo_key and await self._execution_memo.restore(
+                        memo_key, self.get_node_output_edges(node.id)
+                    ):
+                        logger.info(f"Restored outputs of node {node.id}, skipping it")
+                        run.node_finished(node.id, 0, skipped=True)
+                        host_capacity.release(node.id)
+                        nodes_executed.append(node.id)
+                        checkpoint(node)
+                        release_successors(node)
+                        dispatching = None
+                        continue
+
+                    logger.info(f"Executing node: {node.id}")
+                    input_bytes = sum(
+                        get_payload_size(edge.payload_path)
+                        for edge in self.get_node_input_edges(node.id)
+                    )
+                    run.node_started(
+                        node.id,
+                        container_id=node.mercury_container.container_id,
+                        input_bytes=input_bytes,
+                    )
+                    # reset before starting, the exit code can arrive while the
+                    # run command is still being sent to the container
+                    node.mercury_container.reset_notebook_exec()
+                    await node.run()
+                    node_task = asyncio.ensure_future(
+                        node.mercury_container.wait_for_notebook_exec(node.timeout)
+                    )
+                    running[node_task] = node
+                    memo_keys[node_task] = memo_key
+                    dispatching = None
+                for queued in deferred:
+                    heapq.heappush(ready, queued)
+
+                if not running and not backoffs:
+                    # every node dispatched so far had its outputs restored
+                    continue
 
-                    if node_to_execute.mercury_container.notebook_exec_exit_code != -1:
-                        break
+                done, _ = await asyncio.wait(
+                    [stop_requested, *running, *backoffs],
+                    timeout=None
+                    if deadline is None
+                    else max(0, deadline - loop.time()),
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                logger.info(f"dag state : {self._state}")
+
+                if not done:
+                    logger.warning(f"Workflow run timed out after {timeout}s")
+                    stop_requested.cancel()
+                    await self._stop_running_nodes(running, run, backoffs=backoffs)
+                    return 1
 
-                if node_to_execute.mercury_container.notebook_exec_exit_code == 1:
+                if stop_requested in done:
                     logger.info(
-                        "Notebook did not execute successfully or was stopped in the middle.\
-                        Stopping workflow execution"
+                        "Stopping workflow run. Sending stop signal to running nodes"
                     )
+                    await self._stop_running_nodes(running, run, backoffs=backoffs)
                     return 1
 
-                assert node_to_execute.mercury_container.notebook_exec_exit_code == 0
-                logger.info("Notebook executed successfully")
-                nodes_executed.append(node_to_execute.id)
+                for node_task in done:
+                    if node_task in backoffs:
+                        queue_node(backoffs.pop(node_task))
+                        continue
+
+                    node = running.pop(node_task)
+                    host_capacity.release(node.id)
+                    try:
+                        exit_code = node_task.result()
+                    except asyncio.TimeoutError:
+                        logger.warning(
+                            f"Node {node.id} timed out after {node.timeout}s"
+                        )
+                        exit_code = None
+                    memo_key = memo_keys.pop(node_task)
+                    if exit_code != 0 and n_retries[node] < node.retries:
+                        delay = node.retry_backoff * 2 ** n_retries[node]
+                        n_retries[node] += 1
+                        logger.warning(
+                            f"Node {node.id} failed, retry {n_retries[node]} of "
+                            f"{node.retries} in {delay}s"
+                        )
+                        run.node_retrying(
+                            node.id, 1 if exit_code is None else exit_code, delay
+                        )
+                        # a node that timed out may still be running, it is
+                        # stopped during its backoff so as not to hold up the
+                        # scheduling of the other nodes
+                        backoff = self._retry_after(
+                            node, delay, stop_first=exit_code is None
+                        )
+                        backoffs[asyncio.ensure_future(backoff)] = node
+                        continue
+
+                    run.node_finished(node.id, 1 if exit_code is None else exit_code)
+                    if exit_code != 0:
+                        logger.info(
+                            "Notebook did not execute successfully or was stopped in the middle.\
+                            Stopping workflow execution"
+                        )
+                        stop_requested.cancel()
+                        await self._stop_running_nodes(
+                            running,
+                            run,
+                            timed_out=[node] if exit_code is None else [],
+                            backoffs=backoffs,
+                        )
+                        return 1
 
+                    logger.info(f"Notebook for node {node.id} executed successfully")
+                    nodes_executed.append(node.id)
+
+                    if memo_key:
+                        await self._execution_memo.store(
+                            memo_key, self.get_node_output_edges(node.id)
+                        )
+                    checkpoint(node)
+                    release_successors(node)
+
+        except Exception:
+            stop_requested.cancel()
+            failed_to_dispatch = []
+            if dispatching is not None:
+                logger.error(f"Could not dispatch node {dispatching.id}")
+                run.node_finished(dispatching.id, 1)
+                if dispatching.mercury_container:
+                    # its notebook may have been started
+                    failed_to_dispatch.append(dispatching)
+            await self._stop_running_nodes(
+                running, run, timed_out=failed_to_dispatch, backoffs=backoffs
+            )
+            raise
+
+        stop_requested.cancel()
         logger.info(f"{len(nodes_executed)} nodes executed successfully")
         logger.info("Workflow execution successful")
         return 0
+
+    async def _retry_after(
+        self, node: MercuryNode, delay: float, stop_first: bool = False
+    ) -> None:
+        if stop_first:
+            # shielded, a stop cut short by the end of the run could leave the
+            # container half restarted
+            await asyncio.shield(self._stop_node(node))
+        await asyncio.sleep(delay)
+
+    async def _stop_node(self, node: MercuryNode) -> None:
+        try:
+            await node.stop()
+        except Exception:
+            logger.exception(f"Could not stop node {node.id}")
+
+    async def _stop_running_nodes(
+        self,
+        running: Dict[asyncio.Future, MercuryNode],
+        run: WorkflowRun,
+        timed_out: List[MercuryNode] = (),
+        backoffs: Dict[asyncio.Future, MercuryNode] = None,
+    ) -> None:
+        """Stop every in-flight node at once, including nodes that timed out"""
+        for backoff, node in (backoffs or {}).items():
+            backoff.cancel()
+            run.node_stopped(node.id)
+        for node_task, node in running.items():
+            node_task.cancel()
+            run.node_stopped(node.id)
+        nodes_to_stop = [*running.values(), *timed_out]
+
+        stop_results = await asyncio.gather(
+            *[node.stop() for node in nodes_to_stop], return_exceptions=True
+        )
+        for node, stop_result in zip(nodes_to_stop, stop_results):
+            if isinstance(stop_result, Exception):
+                logger.error(f"Could not stop node {node.id}: {stop_result!r}")
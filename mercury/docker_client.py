@@ -1,3 +1,20 @@
+import asyncio
 import docker
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from mercury.constants import DOCKER_MAX_WORKERS
 
 docker_cl = docker.from_env()
+
+# docker-py is blocking, its calls are run on this pool so that they never
+# block the event loop serving requests and running workflows
+docker_executor = ThreadPoolExecutor(
+    max_workers=DOCKER_MAX_WORKERS, thread_name_prefix="mercury-docker"
+)
+
+
+async def run_docker_call(func, *args, **kwargs):
+    """Run a blocking docker-py call on the docker thread pool and await it"""
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(docker_executor, partial(func, *args, **kwargs))
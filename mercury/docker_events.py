@@ -0,0 +1,98 @@
+import asyncio
+import logging
+import threading
+import time
+from typing import Callable
+
+from mercury.docker_client import docker_cl
+from mercury.constants import MERCURY_NODE_LABEL
+
+logger = logging.getLogger(__name__)
+
+# container state after each docker event that changes it
+EVENT_CONTAINER_STATUS = {
+    "create": "created",
+    "start": "running",
+    "restart": "running",
+    "unpause": "running",
+    "pause": "paused",
+    "die": "exited",
+    "stop": "exited",
+    "destroy": "removed",
+}
+
+EVENT_RETRY_INTERVAL = 5
+
+
+class DockerEventWatcher:
+    """Follows the docker events stream for containers started for Mercury nodes
+
+    The blocking events stream is read on a background thread and every state
+    change is handed over to the event loop, where `on_state_change` is called
+    with the node id, the container id and the changes to the container state.
+    """
+
+    def __init__(self, on_state_change: Callable[[str, str, dict], None]):
+        self._on_state_change = on_state_change
+        self._loop: asyncio.AbstractEventLoop = None
+        self._thread: threading.Thread = None
+        self._events = None
+        self._stopped = False
+
+    def start(self, loop: asyncio.AbstractEventLoop = None) -> None:
+        self._loop = loop or asyncio.get_event_loop()
+        self._thread = threading.Thread(
+            target=self._watch, name="mercury-docker-events", daemon=True
+        )
+        self._thread.start()
+        logger.info("Watching docker events for mercury containers")
+
+    def stop(self) -> None:
+        self._stopped = True
+        if self._events is not None:
+            self._events.close()
+
+    def _watch(self) -> None:
+        while not self._stopped:
+            try:
+                self._events = docker_cl.events(
+                    decode=True,
+                    filters={"type": "container", "label": MERCURY_NODE_LABEL},
+                )
+                for event in self._events:
+                    self._loop.call_soon_threadsafe(self._handle_event, event)
+            except Exception:
+                if self._stopped:
+                    break
+                logger.exception("Lost the docker events stream, reconnecting")
+                time.sleep(EVENT_RETRY_INTERVAL)
+
+    def _handle_event(self, event: dict) -> None:
+        action = event.get("status") or event.get("Action", "")
+        if action not in EVENT_CONTAINER_STATUS and action != "oom":
+            return
+
+        attributes = event.get("Actor", {}).get("Attributes", {})
+        node_id = attributes.get(MERCURY_NODE_LABEL)
+        container_id = event.get("id") or event.get("Actor", {}).get("ID")
+
+        if action == "oom":
+            # the oom killer may only have killed a process inside the container,
+            # whether the container itself exited is reported by a die event
+            state_changes = {"OOMKilled": True}
+            logger.warning(
+                f"Container {container_id} of node {node_id} ran out of memory"
+            )
+        else:
+            status = EVENT_CONTAINER_STATUS[action]
+            state_changes = {"Status": status, "Running": status == "running"}
+            if action == "start":
+                state_changes["OOMKilled"] = False
+            if "exitCode" in attributes:
+                state_changes["ExitCode"] = int(attributes["exitCode"])
+            logger.info(f"Container {container_id} of node {node_id} is {status}")
+
+        try:
+            self._on_state_change(node_id, container_id, state_changes)
+        except Exception:
+            logger.exception(f"Could not handle docker event {action}")
@@ -1,11 +1,31 @@
 import logging
-from typing import Tuple
+from typing import List, Tuple
 from uuid import uuid4
 import os
 import json
+import shutil
 
 from mercury.node import MercuryNode
-from mercury.constants import DOCKER_COMMON_VOLUME, BASE_DOCKER_BIND_VOLUME
+from mercury.constants import (
+    DOCKER_COMMON_VOLUME,
+    BASE_DOCKER_BIND_VOLUME,
+    SHM_TRANSPORT,
+    SHM_HOST_DIR,
+    SHM_CONTAINER_DIR,
+    SHM_PAYLOAD_MAX_BYTES,
+    PAYLOAD_COMPRESSION_CODECS,
+    PAYLOAD_COMPRESS_MIN_BYTES,
+)
+from mercury.snippet_cache import snippet_cache
+from mercury.payload import (
+    MANIFEST_FILE,
+    JSON_META_SUFFIX,
+    DEFAULT_PAYLOAD_FORMAT,
+    PAYLOAD_FORMATS,
+    PAYLOAD_FORMAT_JSON,
+    get_kernel_import_snippet,
+    read_manifest,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -16,19 +36,30 @@ class MercuryEdge:
         source_node: MercuryNode = None,
         dest_node: MercuryNode = None,
         source_dest_connect: list = None,
+        payload_format: str = DEFAULT_PAYLOAD_FORMAT,
     ):
+        assert payload_format in PAYLOAD_FORMATS
 
         self.id = uuid4().hex
         self._source_node = source_node
         self._dest_node = dest_node
+        self._payload_format = payload_format
+
+        # json payloads are a single file, binary payloads a directory holding
+        # a manifest and one file per variable
         self._json_path = f"{DOCKER_COMMON_VOLUME}/{self.id}.json"
         self._json_path_container = f"{BASE_DOCKER_BIND_VOLUME}/{self.id}.json"
-        self._json_inputs = None
-
-        if os.path.exists(self._json_path):
-            with open(self._json_path) as f:
-                io = json.load(f)
-            self._json_inputs = list(io.keys().tolist())
+        self._payload_dir = f"{DOCKER_COMMON_VOLUME}/{self.id}"
+        self._payload_dir_container = f"{BASE_DOCKER_BIND_VOLUME}/{self.id}"
+        # binary payloads go to shared memory first when that transport is on
+        self._shm_payload_dir = None
+        self._shm_payload_dir_container = None
+        if SHM_TRANSPORT and payload_format != PAYLOAD_FORMAT_JSON:
+            self._shm_payload_dir = f"{SHM_HOST_DIR}/{self.id}"
+            self._shm_payload_dir_container = f"{SHM_CONTAINER_DIR}/{self.id}"
+        self._payload_inputs = None
+        self._payload_codecs = None
+        self._payload_variables = None
 
         # the connections between source output set and destination input set have to
         # be one-one (injective) but not necessarily onto(surjective)
@@ -57,8 +88,17 @@ class MercuryEdge:
         return self._source_dest_connect
 
     @property
-    def json_inputs(self) -> list:
-        return self._json_inputs
+    def payload_format(self) -> str:
+        return self._payload_format
+
+    @property
+    def payload_inputs(self) -> list:
+        return self._payload_inputs
+
+    @property
+    def payload_codecs(self) -> dict:
+        """Codec used for each variable of the last payload read for this edge"""
+        return self._payload_codecs
 
     @property
     def json_path(self) -> str:
@@ -68,36 +108,224 @@ class MercuryEdge:
     def json_path_container(self) -> str:
         return self._json_path_container
 
-    def get_input_code_snippet(self) -> str:
+    @property
+    def is_payload_in_shm(self) -> bool:
+        """Whether the binary payload is in shared memory rather than on disk"""
+        return self._shm_payload_dir is not None and os.path.exists(
+            os.path.join(self._shm_payload_dir, MANIFEST_FILE)
+        )
+
+    def remove_shm_payload(self) -> None:
+        """Free the shared memory held by the payload, once the edge is removed"""
+        if self._shm_payload_dir is not None:
+            shutil.rmtree(self._shm_payload_dir, ignore_errors=True)
+
+    @property
+    def payload_dir(self) -> str:
+        if self.is_payload_in_shm:
+            return self._shm_payload_dir
+        return self._payload_dir
+
+    @property
+    def payload_dir_container(self) -> str:
+        if self.is_payload_in_shm:
+            return self._shm_payload_dir_container
+        return self._payload_dir_container
+
+    @property
+    def payload_path(self) -> str:
+        if self._payload_format == PAYLOAD_FORMAT_JSON:
+            return self._json_path
+        return self.payload_dir
+
+    @property
+    def payload_stamp_path(self) -> str:
+        """The file that is replaced whenever a new payload is written"""
+        if self._payload_format == PAYLOAD_FORMAT_JSON:
+            return self._json_path
+        return os.path.join(self.payload_dir, MANIFEST_FILE)
+
+    def get_payload_stamp(self) -> tuple:
+        """(mtime, size) of the payload, None if no payload has been written"""
+        try:
+            stat = os.stat(self.payload_stamp_path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    @property
+    def payload_variables(self) -> list:
+        """Name, codec, type and sizes of each variable in the last payload read
+
+        `size` is the serialized size of the variable, `stored_size` the bytes
+        written for it, smaller than `size` when its files are compressed.
+        """
+        return self._payload_variables
+
+    def read_payload_variables(self) -> list:
+        if self._payload_format == PAYLOAD_FORMAT_JSON:
+            payload_variables = self._read_json_payload_variables()
+        else:
+            payload_variables = self._read_binary_payload_variables()
+
+        self._set_payload_variables(payload_variables)
+        return payload_variables
+
+    def _set_payload_variables(self, payload_variables: list) -> None:
+        self._payload_variables = payload_variables
+        if payload_variables is None:
+            self._payload_inputs = None
+            self._payload_codecs = None
+        else:
+            self._payload_inputs = [_["name"] for _ in payload_variables]
+            self._payload_codecs = {_["name"]: _["codec"] for _ in payload_variables}
+
+    def _read_binary_payload_variables(self) -> list:
+        manifest = read_manifest(self.payload_dir)
+        if manifest is None:
+            logger.warning(f"payload for edge {self.id} doesn't exist")
+            return None
+
+        return [
+            {
+                "name": name,
+                "codec": entry["codec"],
+                "type": entry["type"],
+                "size": entry["size"],
+                # payloads written before compression was added lack these
+                "stored_size": entry.get("stored_size", entry["size"]),
+                "compression": sorted(set(entry.get("compression", {}).values())),
+            }
+            for name, entry in manifest["variables"].items()
+        ]
+
+    def _read_json_payload_variables(self) -> list:
         if not os.path.exists(self._json_path):
             logger.warning(f"json for edge {self.id} doesn't exist")
             return None
 
-        with open(self._json_path) as f:
-            logger.info("reading json for edge")
-            io = json.load(f)
-            self._json_inputs = list(io.keys())
+        variables = self._read_json_payload_meta()
+        if variables is None:
+            # written by an older export, the payload itself has to be read
+            with open(self._json_path) as f:
+                logger.info("reading json for edge")
+                io = json.load(f)
+            variables = {}
+            for k, v in io.items():
+                variables[k] = {"type": type(v).__name__, "size": len(json.dumps(v))}
+
+        return [
+            {
+                "name": k,
+                "codec": PAYLOAD_FORMAT_JSON,
+                "type": v["type"],
+                "size": v["size"],
+                "stored_size": v["size"],
+                "compression": [],
+            }
+            for k, v in variables.items()
+        ]
 
-        code_lines = []
+    def _read_json_payload_meta(self) -> dict:
+        """Type and size of each variable as written by the export, if known"""
+        try:
+            with open(self._json_path + JSON_META_SUFFIX) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        # the payload may have been replaced without its meta file
+        if meta["payload_size"] != os.path.getsize(self._json_path):
+            return None
+        return meta["variables"]
+
+    def get_input_code_snippet(self) -> str:
+        """Code loading each variable from the payload, the values are not inlined"""
+        payload_stamp = self.get_payload_stamp()
+        if payload_stamp is None:
+            logger.warning(f"payload for edge {self.id} doesn't exist")
+            self._set_payload_variables(None)
+            return None
+
+        # the payload is only read again once it has been rewritten
+        cached = snippet_cache.get(self.id, "input", payload_stamp)
+        if cached is not None:
+            code, payload_variables = cached
+            self._set_payload_variables(payload_variables)
+            return code
 
-        for k, v in io.items():
-            code_line = f"{k} = {v}"
-            code_lines.append(code_line)
+        if self.read_payload_variables() is None:
+            return None
+
+        code_lines = []
+        for k in self._payload_inputs:
+            if self._payload_format == PAYLOAD_FORMAT_JSON:
+                loader = (
+                    f"mercury_payload.load_json('{self._json_path_container}', '{k}')"
+                )
+            else:
+                loader = f"mercury_payload.load('{self.payload_dir_container}', '{k}')"
+            code_lines.append(f"{k} = {loader}")
 
-        code = "\n".join(code_lines)
+        code = get_kernel_import_snippet() + "\n".join(code_lines)
+        snippet_cache.put(
+            self.id,
+            "input",
+            payload_stamp,
+            (code, self._payload_variables),
+            len(code) + 64 * len(self._payload_variables),
+        )
         return code
 
-    def get_output_code_snippet(self) -> str:
-        code = "import json\n"
-        code += "export_variables = {\n"
+    def get_export_variables(self) -> Tuple[list, list]:
+        """Output names in the source kernel and the input names they are written as"""
+        source_outputs = [_["source"]["output"] for _ in self.source_dest_connect]
+        dest_inputs = [_["destination"]["input"] for _ in self.source_dest_connect]
+        return source_outputs, dest_inputs
 
-        for source_dest_map in self.source_dest_connect:
-            # check type from within the kernel here?
-            source_output_name = source_dest_map["source"]["output"]
-            dest_input_name = source_dest_map["destination"]["input"]
-            code += f"'{dest_input_name}' : {source_output_name}, \n"
 
-        code += "}\n"
-        code += f"json.dump(export_variables, open('{self._json_path_container}', 'w'))"
+def get_export_code_snippet(edges: List[MercuryEdge]) -> str:
+    """Code writing the payloads of all the given edges in a single kernel call
 
-        return code
+    Each exported variable is listed once, however many edges it is sent over,
+    so that the kernel helpers serialize it only once.
+    """
+    export_names = []
+    edge_lines = []
+    for edge in edges:
+        source_outputs, dest_inputs = edge.get_export_variables()
+        for source_output_name in source_outputs:
+            if source_output_name not in export_names:
+                export_names.append(source_output_name)
+        variables = dict(zip(dest_inputs, source_outputs))
+        if edge.payload_format == PAYLOAD_FORMAT_JSON:
+            spec = (edge.payload_format, edge.json_path_container, variables)
+        elif edge._shm_payload_dir_container is not None:
+            # written to shared memory, or to the common volume when too large
+            spec = (
+                edge.payload_format,
+                edge._shm_payload_dir_container,
+                variables,
+                edge._payload_dir_container,
+            )
+        else:
+            spec = (edge.payload_format, edge._payload_dir_container, variables)
+        edge_lines.append(f"        # for destination node {edge.dest_node.id}\n")
+        edge_lines.append(f"        {spec!r},\n")
+
+    code = get_kernel_import_snippet()
+    code += "mercury_payload.dump_edges(\n"
+    code += "    {\n"
+    for name in export_names:
+        # check type from within the kernel here?
+        code += f"        '{name}': {name},\n"
+    code += "    },\n"
+    code += "    [\n"
+    code += "".join(edge_lines)
+    code += "    ],\n"
+    if SHM_TRANSPORT:
+        code += f"    spill_bytes={SHM_PAYLOAD_MAX_BYTES},\n"
+    if PAYLOAD_COMPRESSION_CODECS:
+        code += f"    codecs={PAYLOAD_COMPRESSION_CODECS!r},\n"
+        code += f"    compress_min_bytes={PAYLOAD_COMPRESS_MIN_BYTES},\n"
+    code += ")\n"
+    return code
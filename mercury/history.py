@@ -0,0 +1,223 @@
+import asyncio
+import logging
+import os
+import sqlite3
+from contextlib import closing
+from typing import Dict, Iterable, List, Tuple
+
+import networkx as nx
+
+from mercury.constants import MERCURY_DATA_DIR
+from mercury.run import WorkflowRun, NODE_STATE_SUCCEEDED
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id TEXT PRIMARY KEY,
+    workflow_id TEXT NOT NULL,
+    run_mode TEXT,
+    state TEXT,
+    exit_code INTEGER,
+    created_at REAL,
+    started_at REAL,
+    ended_at REAL
+);
+CREATE INDEX IF NOT EXISTS runs_workflow ON runs (workflow_id, created_at);
+CREATE TABLE IF NOT EXISTS node_runs (
+    run_id TEXT NOT NULL REFERENCES runs (run_id) ON DELETE CASCADE,
+    node_id TEXT NOT NULL,
+    state TEXT,
+    queued_at REAL,
+    started_at REAL,
+    ended_at REAL,
+    exit_code INTEGER,
+    container_id TEXT,
+    input_bytes INTEGER,
+    PRIMARY KEY (run_id, node_id)
+);
+CREATE INDEX IF NOT EXISTS node_runs_node ON node_runs (node_id);
+CREATE TABLE IF NOT EXISTS run_edges (
+    run_id TEXT NOT NULL REFERENCES runs (run_id) ON DELETE CASCADE,
+    source_node_id TEXT NOT NULL,
+    dest_node_id TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS run_edges_run ON run_edges (run_id);
+"""
+
+NODE_RUN_FIELDS = (
+    "state",
+    "queued_at",
+    "started_at",
+    "ended_at",
+    "exit_code",
+    "container_id",
+    "input_bytes",
+)
+
+
+class RunHistory:
+    """Finished workflow runs and the timings of their nodes, kept in SQLite
+
+    Every query opens its own connection, so that the blocking calls can be
+    made on executor threads through the async wrappers.
+    """
+
+    def __init__(self, db_path: str = os.path.join(MERCURY_DATA_DIR, "history.db")):
+        self._db_path = db_path
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        with closing(self._connect()) as conn, conn:
+            conn.executescript(SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self._db_path)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA foreign_keys = ON")
+        return conn
+
+    async def record(self, run: WorkflowRun) -> None:
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self._record, run)
+
+    async def list_runs(self, workflow_id: str, limit: int = 50) -> List[dict]:
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self._list_runs, workflow_id, limit)
+
+    async def get_run(self, run_id: str) -> dict:
+        """A recorded run with its nodes, edges and critical path, None if unknown"""
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self._get_run, run_id)
+
+    async def get_mean_durations(self, node_ids: List[str]) -> Dict[str, float]:
+        """Mean duration of the nodes' successful executions, for those that have one"""
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self._get_mean_durations, node_ids)
+
+    def _record(self, run: WorkflowRun) -> None:
+        run_data = run.to_dict()
+        with closing(self._connect()) as conn, conn:
+            conn.execute("DELETE FROM runs WHERE run_id = ?", (run.id,))
+            conn.execute(
+                "INSERT INTO runs VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    run.id,
+                    run_data["workflow_id"],
+                    run_data["run_mode"],
+                    run_data["state"],
+                    run_data["exit_code"],
+                    run_data["created_at"],
+                    run_data["started_at"],
+                    run_data["ended_at"],
+                ),
+            )
+            conn.executemany(
+                "INSERT INTO node_runs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (run.id, node_id, *[node_run[_] for _ in NODE_RUN_FIELDS])
+                    for node_id, node_run in run_data["nodes"].items()
+                ],
+            )
+            conn.executemany(
+                "INSERT INTO run_edges VALUES (?, ?, ?)",
+                [(run.id, source, dest) for source, dest in run_data["edges"]],
+            )
+
+    def _list_runs(self, workflow_id: str, limit: int) -> List[dict]:
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                "SELECT * FROM runs WHERE workflow_id = ? "
+                "ORDER BY created_at DESC LIMIT ?",
+                (workflow_id, limit),
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def _get_mean_durations(self, node_ids: List[str]) -> Dict[str, float]:
+        if not node_ids:
+            return {}
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                "SELECT node_id, AVG(ended_at - started_at) FROM node_runs "
+                f"WHERE state = ? AND node_id IN ({', '.join('?' * len(node_ids))}) "
+                "GROUP BY node_id",
+                (NODE_STATE_SUCCEEDED, *node_ids),
+            ).fetchall()
+        return {node_id: duration for node_id, duration in rows}
+
+    def _get_run(self, run_id: str) -> dict:
+        with closing(self._connect()) as conn:
+            run_row = conn.execute(
+                "SELECT * FROM runs WHERE run_id = ?", (run_id,)
+            ).fetchone()
+            if run_row is None:
+                return None
+            node_rows = conn.execute(
+                "SELECT * FROM node_runs WHERE run_id = ?", (run_id,)
+            ).fetchall()
+            edge_rows = conn.execute(
+                "SELECT source_node_id, dest_node_id FROM run_edges WHERE run_id = ?",
+                (run_id,),
+            ).fetchall()
+
+        nodes = {}
+        for row in node_rows:
+            node_run = dict(row)
+            del node_run["run_id"]
+            node_id = node_run.pop("node_id")
+            node_run["duration"] = get_duration(node_run)
+            nodes[node_id] = node_run
+        edges = [tuple(row) for row in edge_rows]
+
+        durations = {node_id: nodes[node_id]["duration"] or 0.0 for node_id in nodes}
+        critical_path, critical_path_duration = get_critical_path(durations, edges)
+        total_duration = sum(durations.values())
+        for node_id, node_run in nodes.items():
+            node_run["runtime_share"] = (
+                durations[node_id] / total_duration if total_duration else None
+            )
+            node_run["on_critical_path"] = node_id in critical_path
+
+        return {
+            **dict(run_row),
+            "nodes": nodes,
+            "edges": edges,
+            "critical_path": critical_path,
+            "critical_path_duration": critical_path_duration,
+            "total_node_duration": total_duration,
+        }
+
+
+def get_duration(node_run: dict) -> float:
+    if node_run["started_at"] is None or node_run["ended_at"] is None:
+        return None
+    return node_run["ended_at"] - node_run["started_at"]
+
+
+def get_critical_path(
+    durations: Dict[str, float], edges: Iterable[Tuple[str, str]]
+) -> Tuple[List[str], float]:
+    """Chain of dependent nodes with the largest total duration, and that duration"""
+    graph = nx.DiGraph()
+    graph.add_nodes_from(durations)
+    graph.add_edges_from(edges)
+
+    # longest path ending in each node, weighted by the node durations
+    path_duration = {}
+    predecessor = {}
+    for node_id in nx.topological_sort(graph):
+        path_duration[node_id] = durations.get(node_id, 0.0)
+        predecessor[node_id] = None
+        for source in graph.predecessors(node_id):
+            candidate = path_duration[source] + durations.get(node_id, 0.0)
+            if candidate > path_duration[node_id]:
+                path_duration[node_id] = candidate
+                predecessor[node_id] = source
+
+    if not path_duration:
+        return [], 0.0
+    node_id = max(path_duration, key=path_duration.get)
+    critical_path_duration = path_duration[node_id]
+    critical_path = []
+    while node_id is not None:
+        critical_path.append(node_id)
+        node_id = predecessor[node_id]
+    return critical_path[::-1], critical_path_duration
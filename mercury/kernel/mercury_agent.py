@@ -0,0 +1,115 @@
+"""Long-lived agent running `container.cli` commands inside a node's container
+
+This module is copied to the common volume by the orchestrator and started once
+per container, it only depends on the standard library. It listens on a Unix
+socket in the common volume, so that the orchestrator can send commands without
+a `docker exec` and a new interpreter for every call.
+
+The protocol is newline-delimited json, each request is `{"argv": [...]}` with
+the arguments that would follow `python3 -m container.cli`, each response is
+`{"exit_code": int, "output": str}` with the combined stdout and stderr.
+Commands are run one at a time, in-process, through runpy.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import runpy
+import socketserver
+import sys
+import threading
+import traceback
+
+CLI_MODULE = "container.cli"
+
+# stdout and sys.argv are process wide, commands cannot overlap
+_command_lock = threading.Lock()
+
+
+def run_command(argv):
+    """Run the cli in-process with the given arguments, return exit code and output"""
+    output = io.StringIO()
+    exit_code = 0
+    with _command_lock:
+        saved_argv = sys.argv
+        sys.argv = [CLI_MODULE, *argv]
+        try:
+            with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+                try:
+                    runpy.run_module(CLI_MODULE, run_name="__main__", alter_sys=True)
+                except SystemExit as e:
+                    if isinstance(e.code, int):
+                        exit_code = e.code
+                    elif e.code is not None:
+                        print(e.code, file=sys.stderr)
+                        exit_code = 1
+                except Exception:
+                    traceback.print_exc()
+                    exit_code = 1
+        finally:
+            sys.argv = saved_argv
+    return exit_code, output.getvalue()
+
+
+class AgentRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        # a connection is kept open by the orchestrator for many requests
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                exit_code, output = run_command(request["argv"])
+            except Exception:
+                exit_code, output = 1, traceback.format_exc()
+            response = {"exit_code": exit_code, "output": output}
+            try:
+                self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+                self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                # the orchestrator stopped waiting for this command
+                return
+
+
+class AgentServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def set_socket_owner(socket_path, owner):
+    # the orchestrator runs as a different user on the host
+    uid, gid = (int(_) for _ in owner.split(":"))
+    try:
+        os.chown(socket_path, uid, gid)
+    except PermissionError:
+        # the agent is not root, the orchestrator can connect if it shares the
+        # agent's group
+        os.chmod(socket_path, 0o660)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--socket", required=True)
+    # uid:gid of the orchestrator, the only user allowed to send commands
+    parser.add_argument("--owner")
+    args = parser.parse_args()
+
+    # as with `python3 -m container.cli`, the cli is imported from the cwd
+    sys.path.insert(0, os.getcwd())
+
+    os.makedirs(os.path.dirname(args.socket), exist_ok=True)
+    if os.path.exists(args.socket):
+        os.remove(args.socket)
+    # the socket is created in the common volume, it is closed to other users
+    # before it is bound so that they cannot connect in between
+    old_umask = os.umask(0o177)
+    try:
+        server = AgentServer(args.socket, AgentRequestHandler)
+    finally:
+        os.umask(old_umask)
+    with server:
+        if args.owner:
+            set_socket_owner(args.socket, args.owner)
+        server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,465 @@
+"""Reads and writes Mercury edge payloads from inside a node's jupyter kernel
+
+This module is copied to the common volume by the orchestrator and imported by
+the code snippets it generates, it only depends on the standard library and uses
+numpy, lz4 and zstandard when they are installed in the kernel.
+
+Variables are loaded one at a time by name, so that the generated snippets only
+reference payload files instead of carrying the values themselves.
+
+A payload is a directory holding a `manifest.json` and one blob per variable.
+numpy arrays are stored as `.npy` files and memory-mapped on load, everything
+else is pickled with protocol 5 where available, its out-of-band buffers are
+stored as separate files and memory-mapped on load as well.
+
+All the outgoing edges of a node are written at once with `dump_edges`, a value
+sent over several edges is serialized once and hard-linked into the others. Edges
+can be given a shared memory directory, their payloads are written there unless
+they are too large for it, in which case they spill to the disk directory.
+
+Blobs written to disk can be compressed, with the first of the requested codecs
+that can be imported. Small blobs are left as they are, as are blobs for which a
+sample does not compress well, and the codec of each compressed file is recorded
+in the manifest so that loaders decompress it.
+"""
+import io
+import json
+import mmap
+import os
+import pickle
+import shutil
+import zlib
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MANIFEST_FILE = "manifest.json"
+MANIFEST_VERSION = 1
+# json payloads are described by a small file next to them, so that the
+# orchestrator does not have to parse them
+JSON_META_SUFFIX = ".meta"
+
+CODEC_NPY = "npy"
+CODEC_PICKLE = "pickle"
+
+COMPRESSION_ZLIB = "zlib"
+COMPRESSION_LZ4 = "lz4"
+COMPRESSION_ZSTD = "zstd"
+
+# bytes sampled from a blob to decide whether it is worth compressing
+COMPRESSION_SAMPLE_BYTES = 256 * 1024
+COMPRESSION_SAMPLE_CHUNKS = 4
+# blobs whose sample does not shrink below this ratio are stored as they are
+COMPRESSION_MAX_RATIO = 0.9
+
+# parsed json payloads, keyed by path and validated against the file's mtime
+_json_payloads = {}
+
+
+def _type_name(value):
+    value_type = type(value)
+    return f"{value_type.__module__}.{value_type.__qualname__}"
+
+
+def _is_plain_array(value):
+    return (
+        numpy is not None
+        and isinstance(value, numpy.ndarray)
+        and not value.dtype.hasobject
+    )
+
+
+def _remove(path):
+    # blobs may be hard-linked into other payloads or memory-mapped by a
+    # kernel, they are replaced by new files instead of being overwritten
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _get_compressors():
+    """Compress and decompress functions of the codecs that can be imported"""
+    compressors = {
+        COMPRESSION_ZLIB: (lambda data: zlib.compress(data, 1), zlib.decompress)
+    }
+    if lz4 is not None:
+        compressors[COMPRESSION_LZ4] = (lz4.frame.compress, lz4.frame.decompress)
+    if zstandard is not None:
+        compressors[COMPRESSION_ZSTD] = (
+            zstandard.ZstdCompressor(level=1).compress,
+            zstandard.ZstdDecompressor().decompress,
+        )
+    return compressors
+
+
+_compressors = _get_compressors()
+
+
+def _get_compression(codecs):
+    """First of the requested codecs that is available, None if there is none"""
+    for codec in codecs or ():
+        if codec in _compressors:
+            return codec
+    return None
+
+
+def _get_sample(data):
+    # chunks spread over the blob, its start alone is often a header or padding
+    if data.nbytes <= COMPRESSION_SAMPLE_BYTES:
+        return data
+    chunk_size = COMPRESSION_SAMPLE_BYTES // COMPRESSION_SAMPLE_CHUNKS
+    step = (data.nbytes - chunk_size) // (COMPRESSION_SAMPLE_CHUNKS - 1)
+    return b"".join(
+        data[i * step : i * step + chunk_size] for i in range(COMPRESSION_SAMPLE_CHUNKS)
+    )
+
+
+def _write_blob(payload_dir, file_name, data, compression=None):
+    """Write a blob, compressed when that pays off
+
+    `compression` is a `(codec, min_bytes)` tuple, or None to write it as is.
+    Returns the codec used, None if the blob is not compressed, and its size.
+    """
+    data = memoryview(data).cast("B")
+    size = data.nbytes
+    codec = None
+    if compression is not None and data.nbytes >= compression[1]:
+        compress = _compressors[compression[0]][0]
+        sample = _get_sample(data)
+        if len(compress(sample)) < COMPRESSION_MAX_RATIO * len(sample):
+            codec = compression[0]
+            data = compress(data)
+
+    _remove(os.path.join(payload_dir, file_name))
+    with open(os.path.join(payload_dir, file_name), "wb") as f:
+        f.write(data)
+    return codec, size
+
+
+def _read_blob(payload_dir, file_name, codec):
+    with open(os.path.join(payload_dir, file_name), "rb") as f:
+        return _compressors[codec][1](f.read())
+
+
+def _dump_npy(payload_dir, name, value, compression=None):
+    file_name = f"{name}.npy"
+    entry = {"codec": CODEC_NPY, "file": file_name, "buffers": []}
+    if compression is None or value.nbytes < compression[1]:
+        _remove(os.path.join(payload_dir, file_name))
+        numpy.save(os.path.join(payload_dir, file_name), value, allow_pickle=False)
+        entry["size"] = os.path.getsize(os.path.join(payload_dir, file_name))
+        return entry
+
+    f = io.BytesIO()
+    numpy.save(f, value, allow_pickle=False)
+    codec, entry["size"] = _write_blob(
+        payload_dir, file_name, f.getbuffer(), compression
+    )
+    if codec is not None:
+        entry["compression"] = {file_name: codec}
+    return entry
+
+
+def _pickle(value):
+    buffers = []
+    if pickle.HIGHEST_PROTOCOL >= 5:
+        data = pickle.dumps(value, protocol=5, buffer_callback=buffers.append)
+    else:
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+    return data, buffers
+
+
+def _dump_pickle(payload_dir, name, value, pickled=None, compression=None):
+    data, buffers = _pickle(value) if pickled is None else pickled
+
+    file_name = f"{name}.pkl"
+    codecs = {}
+    codecs[file_name], size = _write_blob(payload_dir, file_name, data, compression)
+
+    buffer_files = []
+    for i, buffer in enumerate(buffers):
+        buffer_file = f"{name}.{i}.buf"
+        codecs[buffer_file], buffer_size = _write_blob(
+            payload_dir, buffer_file, buffer.raw(), compression
+        )
+        size += buffer_size
+        buffer_files.append(buffer_file)
+
+    entry = {"codec": CODEC_PICKLE, "file": file_name, "buffers": buffer_files}
+    entry["size"] = size
+    codecs = {k: v for k, v in codecs.items() if v is not None}
+    if codecs:
+        entry["compression"] = codecs
+    return entry
+
+
+def _map_file(path):
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b""
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _load_npy(payload_dir, entry):
+    codec = entry.get("compression", {}).get(entry["file"])
+    if codec is not None:
+        data = _read_blob(payload_dir, entry["file"], codec)
+        return numpy.load(io.BytesIO(data), allow_pickle=False)
+    return numpy.load(os.path.join(payload_dir, entry["file"]), mmap_mode="r")
+
+
+def _load_pickle(payload_dir, entry):
+    codecs = entry.get("compression", {})
+    if entry["file"] in codecs:
+        data = _read_blob(payload_dir, entry["file"], codecs[entry["file"]])
+    else:
+        with open(os.path.join(payload_dir, entry["file"]), "rb") as f:
+            data = f.read()
+    if not entry["buffers"]:
+        return pickle.loads(data)
+    buffers = [
+        _read_blob(payload_dir, _, codecs[_])
+        if _ in codecs
+        else _map_file(os.path.join(payload_dir, _))
+        for _ in entry["buffers"]
+    ]
+    return pickle.loads(data, buffers=buffers)
+
+
+def _dump_value(payload_dir, name, value, pickled=None, compression=None):
+    if _is_plain_array(value):
+        entry = _dump_npy(payload_dir, name, value, compression)
+    else:
+        entry = _dump_pickle(payload_dir, name, value, pickled, compression)
+    files = [entry["file"], *entry["buffers"]]
+    entry["type"] = _type_name(value)
+    # `size` is the serialized size, before compression
+    entry["stored_size"] = sum(
+        os.path.getsize(os.path.join(payload_dir, _)) for _ in files
+    )
+    return entry
+
+
+def _link_files(source_dir, dest_dir, file_names):
+    for file_name in file_names:
+        dest_path = os.path.join(dest_dir, file_name)
+        _remove(dest_path)
+        try:
+            os.link(os.path.join(source_dir, file_name), dest_path)
+        except OSError:
+            shutil.copyfile(os.path.join(source_dir, file_name), dest_path)
+
+
+def _write_replace(path, write):
+    # readers never see a partially written file
+    tmp_path = os.path.join(
+        os.path.dirname(path), f".{os.path.basename(path)}.{os.getpid()}"
+    )
+    with open(tmp_path, "w") as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+
+def _write_manifest(payload_dir, entries):
+    manifest = {"version": MANIFEST_VERSION, "variables": entries}
+    # the manifest is replaced last so that readers never see a partial payload
+    _write_replace(
+        os.path.join(payload_dir, MANIFEST_FILE), lambda f: json.dump(manifest, f)
+    )
+    return manifest
+
+
+def _get_compression_arg(codecs, compress_min_bytes):
+    codec = _get_compression(codecs)
+    if codec is None:
+        return None
+    return codec, compress_min_bytes or 0
+
+
+def dump(payload_dir, variables, codecs=None, compress_min_bytes=None):
+    """Write the variables, a dict of name to value, as the payload in payload_dir
+
+    Blobs of at least `compress_min_bytes` are compressed with the first of
+    `codecs` that is available, when they compress well.
+    """
+    os.makedirs(payload_dir, exist_ok=True)
+    compression = _get_compression_arg(codecs, compress_min_bytes)
+    entries = {
+        name: _dump_value(payload_dir, name, value, compression=compression)
+        for name, value in variables.items()
+    }
+    manifest = _write_manifest(payload_dir, entries)
+    _remove_unreferenced(payload_dir, entries)
+    return manifest
+
+
+def _remove_unreferenced(payload_dir, entries):
+    """Remove the blobs of earlier payloads that the manifest no longer lists"""
+    referenced = {MANIFEST_FILE}
+    for entry in entries.values():
+        referenced.update([entry["file"], *entry["buffers"]])
+    try:
+        file_names = os.listdir(payload_dir)
+    except FileNotFoundError:
+        return
+    for file_name in file_names:
+        # dot files are manifests being written
+        if file_name not in referenced and not file_name.startswith("."):
+            _remove(os.path.join(payload_dir, file_name))
+
+
+def _get_free_bytes(path):
+    stat = os.statvfs(path)
+    return stat.f_bavail * stat.f_frsize
+
+
+def _remove_manifest(payload_dir):
+    _remove(os.path.join(payload_dir, MANIFEST_FILE))
+
+
+def dump_edges(values, edges, spill_bytes=None, codecs=None, compress_min_bytes=None):
+    """Write the payloads of several edges in one pass over the kernel's variables
+
+    `values` maps the names of the exported kernel variables to their values,
+    `edges` is a list of `(payload_format, path, variables)` where `variables`
+    maps the names on the destination side to the exported names. Each value is
+    serialized at most once per format, binary blobs are hard-linked into the
+    payloads of the other edges that export the same value.
+
+    A binary edge can have a fourth item, the disk directory its payload spills
+    to when it is larger than `spill_bytes` or than what is free at `path`. Only
+    the directory that was written keeps a manifest.
+
+    Blobs written to disk directories are compressed as with `dump`, those in
+    shared memory never are.
+    """
+    compression = _get_compression_arg(codecs, compress_min_bytes)
+    # (exported name, compressed) -> payload dir it was dumped into and its
+    # manifest entry
+    dumped = {}
+    # exported name -> json text of its value
+    encoded = {}
+    # exported name -> pickled value and buffers, for values sized before a dump
+    pickled = {}
+
+    def get_size(name):
+        for compressed in (False, True):
+            if (name, compressed) in dumped:
+                return dumped[name, compressed][1]["size"]
+        value = values[name]
+        if _is_plain_array(value):
+            return value.nbytes
+        if name not in pickled:
+            pickled[name] = _pickle(value)
+        data, buffers = pickled[name]
+        return len(data) + sum(_.raw().nbytes for _ in buffers)
+
+    for payload_format, path, variables, *spill_path in edges:
+        if payload_format == "json":
+            for name in variables.values():
+                if name not in encoded:
+                    encoded[name] = json.dumps(values[name])
+            text = ", ".join(
+                f"{json.dumps(dest_name)}: {encoded[name]}"
+                for dest_name, name in variables.items()
+            )
+            text = "{" + text + "}"
+            meta = {
+                # json.dumps escapes non-ascii characters, chars are bytes
+                "payload_size": len(text),
+                "variables": {
+                    dest_name: {
+                        "type": _type_name(values[name]),
+                        "size": len(encoded[name]),
+                    }
+                    for dest_name, name in variables.items()
+                },
+            }
+            # a meta file never describes another payload than the one next
+            # to it, it is removed before the payload is replaced
+            _remove(path + JSON_META_SUFFIX)
+            _write_replace(path, lambda f: f.write(text))
+            _write_replace(path + JSON_META_SUFFIX, lambda f: json.dump(meta, f))
+            continue
+
+        os.makedirs(path, exist_ok=True)
+        edge_compression = compression
+        if spill_path:
+            spill_path = spill_path[0]
+            size = sum(get_size(_) for _ in set(variables.values()))
+            if size > min(spill_bytes or size, _get_free_bytes(path)):
+                path, spill_path = spill_path, path
+                os.makedirs(path, exist_ok=True)
+            else:
+                edge_compression = None
+            # readers find the payload through the only manifest left, the
+            # blobs of that directory are removed once the payload is written
+            _remove_manifest(spill_path)
+
+        entries = {}
+        for dest_name, name in variables.items():
+            key = (name, edge_compression is not None)
+            if key not in dumped:
+                dumped[key] = (
+                    path,
+                    _dump_value(
+                        path,
+                        name,
+                        values[name],
+                        pickled.pop(name, None),
+                        edge_compression,
+                    ),
+                )
+            source_dir, entry = dumped[key]
+            if source_dir != path:
+                _link_files(source_dir, path, [entry["file"], *entry["buffers"]])
+            entries[dest_name] = dict(entry)
+        _write_manifest(path, entries)
+        _remove_unreferenced(path, entries)
+        if spill_path:
+            _remove_unreferenced(spill_path, {})
+
+
+def read_manifest(payload_dir):
+    with open(os.path.join(payload_dir, MANIFEST_FILE)) as f:
+        return json.load(f)
+
+
+def load(payload_dir, name, manifest=None):
+    """Load a single variable of the payload in payload_dir"""
+    if manifest is None:
+        manifest = read_manifest(payload_dir)
+    entry = manifest["variables"][name]
+    if entry["codec"] == CODEC_NPY:
+        return _load_npy(payload_dir, entry)
+    return _load_pickle(payload_dir, entry)
+
+
+def load_all(payload_dir):
+    """Load all the variables of the payload in payload_dir as a dict"""
+    manifest = read_manifest(payload_dir)
+    return {name: load(payload_dir, name, manifest) for name in manifest["variables"]}
+
+
+def load_json(json_path, name):
+    """Load a single variable of a json payload, the file is only parsed once"""
+    mtime = os.stat(json_path).st_mtime_ns
+    cached = _json_payloads.get(json_path)
+    if cached is None or cached[0] != mtime:
+        with open(json_path) as f:
+            cached = (mtime, json.load(f))
+        _json_payloads[json_path] = cached
+    return cached[1][name]
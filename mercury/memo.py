@@ -0,0 +1,213 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+from typing import List
+
+from mercury.constants import (
+    MERCURY_DATA_DIR,
+    EXECUTION_MEMO_MAX_BYTES,
+    EXECUTION_MEMO_MAX_AGE,
+)
+from mercury.edge import MercuryEdge
+from mercury.node import MercuryNode
+from mercury.payload import (
+    JSON_META_SUFFIX,
+    MANIFEST_FILE,
+    PAYLOAD_FORMAT_JSON,
+    get_payload_files,
+    hash_payload,
+)
+
+logger = logging.getLogger(__name__)
+
+META_FILE = "meta.json"
+
+
+class ExecutionMemo:
+    """Outputs of successful node executions, addressed by everything they depend on
+
+    The key of an execution hashes the node's committed image, its notebook, the
+    payloads of its input edges and the variables it exports on its output edges.
+    When a node is about to run with a key that has been recorded before, the
+    recorded output payloads are copied back and the execution is skipped.
+
+    Entries are stored under `cache_dir` and evicted, least recently used first,
+    once they are older than `max_age` seconds or take more than `max_bytes`.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str = os.path.join(MERCURY_DATA_DIR, "memo"),
+        max_bytes: int = EXECUTION_MEMO_MAX_BYTES,
+        max_age: float = EXECUTION_MEMO_MAX_AGE,
+    ):
+        self._cache_dir = cache_dir
+        self._max_bytes = max_bytes
+        self._max_age = max_age
+
+    async def get_key(
+        self,
+        node: MercuryNode,
+        input_edges: List[MercuryEdge],
+        output_edges: List[MercuryEdge],
+    ) -> str:
+        """Key of the node's next execution, None if it cannot be memoized"""
+        if not output_edges:
+            # all a node without outputs does are side effects, e.g. saving a
+            # model, it is always executed
+            return None
+
+        notebook_hash = await node.get_notebook_hash()
+        if notebook_hash is None:
+            return None
+
+        loop = asyncio.get_event_loop()
+        input_hashes = []
+        for edge in sorted(input_edges, key=lambda _: _.id):
+            payload_hash = await loop.run_in_executor(
+                None, hash_payload, edge.payload_path
+            )
+            if payload_hash is None:
+                return None
+            input_hashes.append([edge.id, payload_hash])
+
+        exports = [
+            [edge.id, edge.payload_format, *edge.get_export_variables()]
+            for edge in sorted(output_edges, key=lambda _: _.id)
+        ]
+        key_data = {
+            "image": f"{node.docker_img_name}:{node.docker_img_tag}",
+            "notebook": notebook_hash,
+            "inputs": input_hashes,
+            "exports": exports,
+        }
+        return hashlib.sha256(json.dumps(key_data).encode()).hexdigest()
+
+    async def restore(self, key: str, output_edges: List[MercuryEdge]) -> bool:
+        """Copy the recorded outputs back to the edges, False if there are none"""
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self._restore, key, output_edges)
+
+    async def store(self, key: str, output_edges: List[MercuryEdge]) -> None:
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self._store, key, output_edges)
+
+    def _restore(self, key: str, output_edges: List[MercuryEdge]) -> bool:
+        entry_dir = os.path.join(self._cache_dir, key)
+        meta_path = os.path.join(entry_dir, META_FILE)
+        if not os.path.exists(meta_path):
+            return False
+
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if time.time() - meta["created"] > self._max_age:
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            return False
+
+        for edge in output_edges:
+            if edge.payload_format == PAYLOAD_FORMAT_JSON:
+                # describes the payload being replaced
+                _remove(edge.payload_path + JSON_META_SUFFIX)
+            _copy_payload(os.path.join(entry_dir, edge.id), edge.payload_path)
+            meta_path = os.path.join(entry_dir, edge.id + JSON_META_SUFFIX)
+            if os.path.exists(meta_path):
+                _copy_replace(meta_path, edge.payload_path + JSON_META_SUFFIX)
+
+        meta["last_used"] = time.time()
+        with open(meta_path, "w") as f:
+            json.dump(meta, f)
+        return True
+
+    def _store(self, key: str, output_edges: List[MercuryEdge]) -> None:
+        for edge in output_edges:
+            if not get_payload_files(edge.payload_path):
+                logger.warning(f"Edge {edge.id} has no payload, not memoizing")
+                return
+
+        entry_dir = os.path.join(self._cache_dir, key)
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        os.makedirs(entry_dir)
+        for edge in output_edges:
+            _copy_payload(edge.payload_path, os.path.join(entry_dir, edge.id))
+            meta_path = edge.payload_path + JSON_META_SUFFIX
+            if edge.payload_format == PAYLOAD_FORMAT_JSON and os.path.exists(meta_path):
+                shutil.copy2(
+                    meta_path, os.path.join(entry_dir, edge.id + JSON_META_SUFFIX)
+                )
+
+        now = time.time()
+        meta = {"created": now, "last_used": now, "size": _get_size(entry_dir)}
+        with open(os.path.join(entry_dir, META_FILE), "w") as f:
+            json.dump(meta, f)
+        logger.info(f"Memoized execution {key}")
+
+        self._evict()
+
+    def _evict(self) -> None:
+        entries = []
+        for key in os.listdir(self._cache_dir):
+            meta_path = os.path.join(self._cache_dir, key, META_FILE)
+            try:
+                with open(meta_path) as f:
+                    entries.append((key, json.load(f)))
+            except (OSError, ValueError):
+                shutil.rmtree(os.path.join(self._cache_dir, key), ignore_errors=True)
+
+        entries.sort(key=lambda _: _[1]["last_used"])
+        total_size = sum(meta["size"] for _, meta in entries)
+        now = time.time()
+        for key, meta in entries:
+            if total_size <= self._max_bytes and now - meta["created"] <= self._max_age:
+                continue
+            logger.info(f"Evicting memoized execution {key}")
+            shutil.rmtree(os.path.join(self._cache_dir, key), ignore_errors=True)
+            total_size -= meta["size"]
+
+
+def _copy_payload(source_path: str, dest_path: str) -> None:
+    """Copy a payload over another, readers never see it missing or partial
+
+    Files are copied next to their destination and moved into place, the
+    manifest of a payload directory last, as when the kernel writes a payload.
+    """
+    if not os.path.isdir(source_path):
+        _copy_replace(source_path, dest_path)
+        return
+
+    os.makedirs(dest_path, exist_ok=True)
+    # dot files are partially written manifests
+    file_names = [_ for _ in os.listdir(source_path) if not _.startswith(".")]
+    for file_name in sorted(file_names, key=lambda _: _ == MANIFEST_FILE):
+        _copy_replace(
+            os.path.join(source_path, file_name), os.path.join(dest_path, file_name)
+        )
+    for file_name in os.listdir(dest_path):
+        if file_name not in file_names and not file_name.startswith("."):
+            os.remove(os.path.join(dest_path, file_name))
+
+
+def _copy_replace(source_path: str, dest_path: str) -> None:
+    tmp_path = os.path.join(
+        os.path.dirname(dest_path), f".{os.path.basename(dest_path)}.{os.getpid()}"
+    )
+    shutil.copy2(source_path, tmp_path)
+    os.replace(tmp_path, dest_path)
+
+
+def _remove(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _get_size(path: str) -> int:
+    return sum(
+        os.path.getsize(os.path.join(root, _))
+        for root, _dirs, files in os.walk(path)
+        for _ in files
+    )
@@ -1,20 +1,65 @@
+import asyncio
+import docker
 import logging
 from uuid import uuid4
 import copy
 
-
-from mercury.docker_client import docker_cl
+from mercury.docker_client import docker_cl, run_docker_call
 from mercury.constants import (
     DEFAULT_DOCKER_VOL_MODE,
     DOCKER_COMMON_VOLUME,
     BASE_DOCKER_IMAGE_NAME,
     BASE_DOCKER_BIND_VOLUME,
+    MERCURY_NODE_LABEL,
+    NOTEBOOK_PATH,
+    NODE_TIMEOUT,
+    NODE_STOP_GRACE_PERIOD,
+    NODE_RETRY_BACKOFF,
+    USE_CONTAINER_AGENT,
+    SHM_TRANSPORT,
+    SHM_HOST_DIR,
+    SHM_CONTAINER_DIR,
 )
-from mercury.container import MercuryContainer
+from mercury.container import MercuryContainer, container_state_cache
+from mercury.snippet_cache import snippet_cache
+from mercury.resources import get_docker_limits, parse_cpus, parse_memory
+from mercury.agent import start_agent
 
 logger = logging.getLogger(__name__)
 
 
+async def start_node_container(
+    node_id: str, jupyter_port: int, cpus: float = None, memory: int = None
+) -> docker.models.containers.Container:
+    """Start a jupyter-mercury container that identifies itself as the given node"""
+    volumes = {
+        DOCKER_COMMON_VOLUME: {
+            "bind": BASE_DOCKER_BIND_VOLUME,
+            "mode": DEFAULT_DOCKER_VOL_MODE,
+        }
+    }
+    if SHM_TRANSPORT:
+        volumes[SHM_HOST_DIR] = {"bind": SHM_CONTAINER_DIR, "mode": "rw"}
+
+    container_run = await run_docker_call(
+        docker_cl.containers.run,
+        BASE_DOCKER_IMAGE_NAME,
+        environment={"MERCURY_NODE": node_id},
+        labels={MERCURY_NODE_LABEL: node_id},
+        volumes=volumes,
+        detach=True,
+        ports={"8888/tcp": jupyter_port},
+        **get_docker_limits(cpus, memory),
+    )
+    # seed the state cache, the container is not in its last refresh
+    await run_docker_call(container_run.reload)
+    container_state_cache.update(container_run.id, container_run.attrs["State"])
+    # commands are sent to it instead of starting an interpreter for each
+    if USE_CONTAINER_AGENT:
+        await start_agent(container_run)
+    return container_run
+
+
 class MercuryNode:
     def __init__(
         self,
@@ -22,8 +67,15 @@ class MercuryNode:
         output: list = None,
         docker_volume: str = None,  # TODO: make a default docker volume
         docker_img_name: str = None,
+        node_id: str = None,
+        cpus: float = None,
+        memory: int = None,
+        timeout: float = NODE_TIMEOUT,
+        retries: int = 0,
+        retry_backoff: float = NODE_RETRY_BACKOFF,
     ):
-        self.id = uuid4().hex
+        # a node can take over the id of a container started for it in advance
+        self.id = uuid4().hex if node_id is None else node_id
         self._input = input
         self._output = output
 
@@ -33,7 +85,17 @@ class MercuryNode:
 
         # Here, the container is itself changing on every execution
         self._mercury_container: MercuryContainer = None
-        self._jupyter_port: int = 8880
+        # assigned by the dag when the node is added to it
+        self._jupyter_port: int = None
+
+        # resources requested by the node, enforced as limits on its container
+        self._cpus = parse_cpus(cpus)
+        self._memory = parse_memory(memory)
+        # seconds the notebook run may take before the workflow fails
+        self.timeout = timeout
+        # times a failed notebook run is retried, with exponential backoff
+        self.retries = retries
+        self.retry_backoff = retry_backoff
 
     def __str__(self) -> str:
         return self.id
@@ -49,6 +111,7 @@ class MercuryNode:
     @input.setter
     def input(self, input_fields: list) -> None:
         self._input = input_fields
+        snippet_cache.invalidate(self.id)
 
     @property
     def output(self) -> list:
@@ -57,6 +120,7 @@ class MercuryNode:
     @output.setter
     def output(self, output_fields: list) -> None:
         self._output = output_fields
+        snippet_cache.invalidate(self.id)
 
     @property
     def docker_img_name(self) -> str:
@@ -74,7 +138,50 @@ class MercuryNode:
     def jupyter_port(self, port: int) -> int:
         self._jupyter_port = port
 
-    def initialise_container(self):
+    @property
+    def cpus(self) -> float:
+        return self._cpus
+
+    @property
+    def memory(self) -> int:
+        return self._memory
+
+    @property
+    def timeout(self) -> float:
+        return self._timeout
+
+    @timeout.setter
+    def timeout(self, timeout: float) -> None:
+        assert timeout is None or timeout > 0
+        self._timeout = timeout
+
+    @property
+    def retries(self) -> int:
+        return self._retries
+
+    @retries.setter
+    def retries(self, retries: int) -> None:
+        assert retries >= 0
+        self._retries = retries
+
+    @property
+    def retry_backoff(self) -> float:
+        return self._retry_backoff
+
+    @retry_backoff.setter
+    def retry_backoff(self, retry_backoff: float) -> None:
+        assert retry_backoff >= 0
+        self._retry_backoff = retry_backoff
+
+    async def set_resources(self, cpus: float = None, memory: int = None) -> None:
+        """Change the requested resources, also limiting the running container"""
+        cpus, memory = parse_cpus(cpus), parse_memory(memory)
+        self._cpus = cpus
+        self._memory = memory
+        if self._mercury_container:
+            await self._mercury_container.update_resources(self._cpus, self._memory)
+
+    async def initialise_container(self):
         """This should start the jupyter notebook inside the docker container
 
         Parameters
@@ -87,24 +194,21 @@ class MercuryNode:
         str
             container id of the running container
         """
-        container_run = docker_cl.containers.run(
-            BASE_DOCKER_IMAGE_NAME,
-            environment={"MERCURY_NODE": self.id},
-            volumes={
-                DOCKER_COMMON_VOLUME: {
-                    "bind": BASE_DOCKER_BIND_VOLUME,
-                    "mode": DEFAULT_DOCKER_VOL_MODE,
-                }
-            },
-            detach=True,
-            ports={"8888/tcp": self._jupyter_port},
+        container_run = await start_node_container(
+            self.id, self._jupyter_port, self._cpus, self._memory
         )
         self._mercury_container = MercuryContainer(container_run)
         logger.info(f"Initialised container {self._mercury_container.container_id}")
 
-    def commit(self) -> str:
+    def attach_container(self, container: docker.models.containers.Container):
+        """Use an already running container, started with this node's id"""
+        assert self._mercury_container is None
+        self._mercury_container = MercuryContainer(container)
+        logger.info(f"Attached container {self._mercury_container.container_id}")
+
+    async def commit(self) -> str:
         self._docker_img_tag = str(int(self._docker_img_tag) + 1)
-        self._mercury_container.commit(
+        await self._mercury_container.commit(
             build_img_name=self._docker_img_name, build_img_tag=self._docker_img_tag
         )
 
@@ -114,7 +218,7 @@ class MercuryNode:
     # run can either start a new container if a container is not
     # running for the node, or reuse the running container for running
     # the workflow in the notebook.
-    def run(self) -> None:
+    async def run(self) -> None:
         """Run the node end to end.
 
         Returns
@@ -125,35 +229,70 @@ class MercuryNode:
         logger.info("Running notebook in container")
 
         if not self._mercury_container:
-            self.initialise_container()
+            await self.initialise_container()
+        await container_state_cache.ensure_fresh(self._mercury_container.container_id)
         assert self._mercury_container.container_state["Running"]
 
         logger.info(f"Running in container {self._mercury_container.container_id}")
-        cmd = "python3 -m container.cli run-notebook --notebook_path='work/scripts/Untitled.ipynb'"
+        cmd = f"python3 -m container.cli run-notebook --notebook_path='{NOTEBOOK_PATH}'"
         # detached state could be used for running multiple containers together in workflow run
-        self._mercury_container.container.exec_run(cmd, detach=True)
+        await self._mercury_container.exec_run(cmd, detach=True)
 
-    def stop(self) -> str:
-        logger.info("stopping notebook in container")
-        logger.info(
-            f"stopping process {self._mercury_container.notebook_exec_pid} in container"
-        )
+    async def stop(self, grace_period: float = NODE_STOP_GRACE_PERIOD) -> None:
+        """Stop the notebook run, restarting the container if it does not exit
 
-        assert self._mercury_container._notebook_exec_pid
+        The run is killed through the pid it reported. Runs without a pid, or
+        whose process is still alive after the grace period, can only be ended
+        by restarting the container.
+        """
+        pid = self._mercury_container.notebook_exec_pid
+        logger.info(f"stopping process {pid} in container")
 
-        cmd = f"kill {self._mercury_container._notebook_exec_pid}"
-        exit_code, output = self._mercury_container.container.exec_run(
-            cmd, detach=False
-        )
+        if pid and await self._signal_notebook_exec(pid, grace_period):
+            logger.info(f"Stopped the notebook run of node {self.id}")
+        else:
+            logger.warning(f"Restarting the container of node {self.id} to stop it")
+            await self._mercury_container.restart()
         self._mercury_container.notebook_exec_exit_code = 1
-        return exit_code, output
 
-    def execute_code(self, code) -> tuple:
-        return self._mercury_container.execute_code(code)
+    async def _signal_notebook_exec(self, pid: int, grace_period: float) -> bool:
+        """Kill the notebook run, True once its process has exited"""
+        # kill -0 only checks whether the process still exists, a run that
+        # already exited, e.g. as it finished, is stopped without a restart
+        if not await self._is_process_alive(pid):
+            return True
+        exit_code, _ = await self._mercury_container.exec_run(f"kill {pid}")
+        if exit_code != 0:
+            # no such process if it exited in the meantime
+            return not await self._is_process_alive(pid)
+
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + grace_period
+        while True:
+            if not await self._is_process_alive(pid):
+                return True
+            if loop.time() >= deadline:
+                return False
+            await asyncio.sleep(min(0.5, grace_period))
+
+    async def _is_process_alive(self, pid: int) -> bool:
+        exit_code, _ = await self._mercury_container.exec_run(f"kill -0 {pid}")
+        return exit_code == 0
 
-    def write_output_to_json(
-        self, source_outputs: list, dest_inputs: list, json_fp: str
-    ) -> tuple:
-        return self._mercury_container.write_variables_to_json(
-            source_outputs, dest_inputs, json_fp
+    async def get_notebook_hash(self) -> str:
+        """sha256 of the notebook run for this node, None if it cannot be read"""
+        if not self._mercury_container:
+            return None
+        exit_code, output = await self._mercury_container.exec_run(
+            f"sha256sum '{NOTEBOOK_PATH}'"
         )
+        if exit_code != 0:
+            logger.warning(f"Could not hash the notebook of node {self.id}")
+            return None
+        return output.decode("utf-8").split()[0]
+
+    async def kill(self) -> None:
+        await self._mercury_container.kill()
+
+    async def execute_code(self, code) -> tuple:
+        return await self._mercury_container.execute_code(code)
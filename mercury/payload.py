@@ -0,0 +1,99 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+from mercury.constants import (
+    DOCKER_COMMON_VOLUME,
+    BASE_DOCKER_BIND_VOLUME,
+    KERNEL_HELPERS_DIR,
+    SHM_TRANSPORT,
+    SHM_HOST_DIR,
+)
+
+logger = logging.getLogger(__name__)
+
+PAYLOAD_FORMAT_JSON = "json"
+PAYLOAD_FORMAT_BINARY = "binary"
+PAYLOAD_FORMATS = (PAYLOAD_FORMAT_JSON, PAYLOAD_FORMAT_BINARY)
+DEFAULT_PAYLOAD_FORMAT = PAYLOAD_FORMAT_BINARY
+
+MANIFEST_FILE = "manifest.json"
+JSON_META_SUFFIX = ".meta"
+
+KERNEL_HELPERS_SOURCE = os.path.join(os.path.dirname(__file__), "kernel")
+KERNEL_HELPERS_HOST_DIR = os.path.join(DOCKER_COMMON_VOLUME, KERNEL_HELPERS_DIR)
+KERNEL_HELPERS_CONTAINER_DIR = f"{BASE_DOCKER_BIND_VOLUME}/{KERNEL_HELPERS_DIR}"
+
+
+def install_kernel_helpers() -> None:
+    """Copy the modules imported by generated code snippets to the common volume"""
+    os.makedirs(KERNEL_HELPERS_HOST_DIR, exist_ok=True)
+    for file_name in os.listdir(KERNEL_HELPERS_SOURCE):
+        if file_name.endswith(".py"):
+            shutil.copy(
+                os.path.join(KERNEL_HELPERS_SOURCE, file_name), KERNEL_HELPERS_HOST_DIR
+            )
+    logger.info(f"Installed kernel helpers to {KERNEL_HELPERS_HOST_DIR}")
+
+
+def prepare_shm_dir() -> None:
+    """Create the shared memory directory for payloads, if that transport is used"""
+    if not SHM_TRANSPORT:
+        return
+    os.makedirs(SHM_HOST_DIR, exist_ok=True)
+    # containers may write to it as another user than the orchestrator's
+    os.chmod(SHM_HOST_DIR, 0o777)
+    logger.info(f"Edge payloads are kept in shared memory in {SHM_HOST_DIR}")
+
+
+def get_kernel_import_snippet() -> str:
+    """Code that makes the kernel helpers importable inside a node's kernel"""
+    code = "import sys\n"
+    code += f"if '{KERNEL_HELPERS_CONTAINER_DIR}' not in sys.path:\n"
+    code += f"    sys.path.insert(0, '{KERNEL_HELPERS_CONTAINER_DIR}')\n"
+    code += "import mercury_payload\n"
+    return code
+
+
+def read_manifest(payload_dir: str) -> dict:
+    """Read the manifest of a binary payload on the host, None if it is not written"""
+    manifest_path = os.path.join(payload_dir, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def get_payload_files(payload_path: str) -> list:
+    """Files making up a payload, a json file or the contents of a payload directory"""
+    if os.path.isfile(payload_path):
+        return [payload_path]
+    if not os.path.isdir(payload_path):
+        return []
+    # dot files are partially written manifests
+    return [
+        os.path.join(payload_path, _)
+        for _ in sorted(os.listdir(payload_path))
+        if not _.startswith(".")
+    ]
+
+
+def get_payload_size(payload_path: str) -> int:
+    return sum(os.path.getsize(_) for _ in get_payload_files(payload_path))
+
+
+def hash_payload(payload_path: str) -> str:
+    """sha256 over the names and contents of the payload files, None if missing"""
+    payload_files = get_payload_files(payload_path)
+    if not payload_files:
+        return None
+
+    payload_hash = hashlib.sha256()
+    for file_path in payload_files:
+        payload_hash.update(os.path.basename(file_path).encode())
+        with open(file_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                payload_hash.update(chunk)
+    return payload_hash.hexdigest()
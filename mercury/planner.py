@@ -0,0 +1,76 @@
+import heapq
+from itertools import count
+from typing import Dict, Iterable, List, Tuple
+
+import networkx as nx
+
+
+def get_upward_ranks(
+    durations: Dict[str, float], edges: Iterable[Tuple[str, str]]
+) -> Dict[str, float]:
+    """Estimated duration of the longest path from each node to a sink
+
+    Running the nodes with the largest rank first keeps the critical path busy,
+    which shortens the makespan when more nodes are ready than there are slots.
+    """
+    graph = nx.DiGraph()
+    graph.add_nodes_from(durations)
+    graph.add_edges_from(edges)
+
+    ranks = {}
+    for node_id in reversed(list(nx.topological_sort(graph))):
+        ranks[node_id] = durations.get(node_id, 0.0) + max(
+            (ranks[_] for _ in graph.successors(node_id)), default=0.0
+        )
+    return ranks
+
+
+def plan_schedule(
+    durations: Dict[str, float],
+    edges: Iterable[Tuple[str, str]],
+    n_max_parallel: int,
+) -> dict:
+    """Simulate a run with the scheduler's priorities and the estimated durations
+
+    Returns the predicted makespan and the start and end time of every node,
+    relative to the start of the run.
+    """
+    assert n_max_parallel > 0
+    edges = list(edges)
+    ranks = get_upward_ranks(durations, edges)
+    successors = {node_id: [] for node_id in durations}
+    in_degree = {node_id: 0 for node_id in durations}
+    for source, dest in edges:
+        successors[source].append(dest)
+        in_degree[dest] += 1
+
+    order = count()
+    ready = [
+        (-ranks[_], next(order), _) for _, degree in in_degree.items() if not degree
+    ]
+    heapq.heapify(ready)
+    running: List[Tuple[float, int, str]] = []
+    schedule = []
+    now = 0.0
+
+    while ready or running:
+        while ready and len(running) < n_max_parallel:
+            _, _, node_id = heapq.heappop(ready)
+            end = now + durations[node_id]
+            heapq.heappush(running, (end, next(order), node_id))
+            schedule.append(
+                {
+                    "node_id": node_id,
+                    "start": now,
+                    "end": end,
+                    "rank": ranks[node_id],
+                }
+            )
+
+        now, _, node_id = heapq.heappop(running)
+        for successor in successors[node_id]:
+            in_degree[successor] -= 1
+            if in_degree[successor] == 0:
+                heapq.heappush(ready, (-ranks[successor], next(order), successor))
+
+    return {"makespan": now, "n_max_parallel": n_max_parallel, "schedule": schedule}
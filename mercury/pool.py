@@ -0,0 +1,145 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Callable, Deque
+from uuid import uuid4
+
+import docker
+
+from mercury.constants import (
+    WARM_POOL_MIN_SIZE,
+    WARM_POOL_MAX_SIZE,
+    WARM_POOL_RATE_WINDOW,
+)
+from mercury.agent import remove_agent_socket
+from mercury.docker_client import run_docker_call
+from mercury.container import container_state_cache
+from mercury.node import start_node_container
+
+logger = logging.getLogger(__name__)
+
+
+class PooledContainer:
+    """An idle container, started in advance for a node id that is not used yet"""
+
+    def __init__(
+        self,
+        node_id: str,
+        jupyter_port: int,
+        container: docker.models.containers.Container,
+    ):
+        self.node_id = node_id
+        self.jupyter_port = jupyter_port
+        self.container = container
+
+
+class WarmContainerPool:
+    """Keeps jupyter-mercury containers running so that new nodes can claim them
+
+    Pooled containers already have the common volume mounted and a jupyter port
+    mapped. Their MERCURY_NODE identity is a fresh node id, which the node that
+    claims the container takes over. The pool is refilled in the background and
+    sized after the number of nodes created within the last `rate_window` seconds.
+    """
+
+    def __init__(
+        self,
+        reserve_port: Callable[[], int],
+        release_port: Callable[[int], None],
+        min_size: int = WARM_POOL_MIN_SIZE,
+        max_size: int = WARM_POOL_MAX_SIZE,
+        rate_window: float = WARM_POOL_RATE_WINDOW,
+    ):
+        assert 0 <= min_size <= max_size
+        self._reserve_port = reserve_port
+        self._release_port = release_port
+        self._min_size = min_size
+        self._max_size = max_size
+        self._rate_window = rate_window
+
+        self._idle: Deque[PooledContainer] = deque()
+        self._n_starting: int = 0
+        self._creation_times: Deque[float] = deque()
+        self._refill_task: asyncio.Future = None
+
+    @property
+    def size(self) -> int:
+        return len(self._idle)
+
+    @property
+    def target_size(self) -> int:
+        window_start = time.monotonic() - self._rate_window
+        while self._creation_times and self._creation_times[0] < window_start:
+            self._creation_times.popleft()
+        n_recent = len(self._creation_times)
+        return max(self._min_size, min(self._max_size, n_recent))
+
+    def claim(self) -> PooledContainer:
+        """Take an idle container for a new node, None if the pool is empty"""
+        self._creation_times.append(time.monotonic())
+        pooled = None
+        while self._idle and pooled is None:
+            pooled = self._idle.popleft()
+            # docker events keep the cached state of pooled containers current
+            container_state = container_state_cache.get_cached(pooled.container.id)
+            if not container_state.get("Running", False):
+                logger.warning(f"Dropping pooled container {pooled.container.id}")
+                self._release_port(pooled.jupyter_port)
+                asyncio.ensure_future(self._remove_container(pooled.container))
+                pooled = None
+
+        if pooled is None:
+            logger.info("Warm pool is empty, the node needs a new container")
+        else:
+            logger.info(f"Claimed pooled container {pooled.container.id}")
+        self.refill()
+        return pooled
+
+    def refill(self) -> None:
+        """Start containers in the background until the pool has its target size"""
+        if self._refill_task is None or self._refill_task.done():
+            self._refill_task = asyncio.ensure_future(self._refill())
+
+    async def _refill(self) -> None:
+        while self.size + self._n_starting < self.target_size:
+            n_missing = self.target_size - self.size - self._n_starting
+            logger.info(f"Starting {n_missing} containers for the warm pool")
+            self._n_starting += n_missing
+            started = await asyncio.gather(
+                *[self._start_container() for _ in range(n_missing)]
+            )
+            if not all(started):
+                # retried on the next claim instead of failing in a loop
+                break
+
+    async def _start_container(self) -> bool:
+        node_id = uuid4().hex
+        jupyter_port = self._reserve_port()
+        try:
+            container = await start_node_container(node_id, jupyter_port)
+        except Exception:
+            logger.exception("Could not start a container for the warm pool")
+            self._release_port(jupyter_port)
+            return False
+        finally:
+            self._n_starting -= 1
+
+        self._idle.append(PooledContainer(node_id, jupyter_port, container))
+        return True
+
+    async def _remove_container(
+        self, container: docker.models.containers.Container
+    ) -> None:
+        try:
+            await run_docker_call(container.remove, force=True)
+        except Exception:
+            logger.exception(f"Could not remove pooled container {container.id}")
+        remove_agent_socket(container.id)
+
+    async def shutdown(self) -> None:
+        while self._idle:
+            pooled = self._idle.popleft()
+            await run_docker_call(pooled.container.kill)
+            remove_agent_socket(pooled.container.id)
+            self._release_port(pooled.jupyter_port)
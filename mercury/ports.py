@@ -0,0 +1,72 @@
+import logging
+import socket
+from collections import deque
+from typing import Deque, List, Set
+
+from mercury.constants import JUPYTER_PORT_RANGE_START, JUPYTER_PORT_RANGE_END
+
+logger = logging.getLogger(__name__)
+
+
+class PortAllocator:
+    """Hands out host ports from a fixed range and takes them back for reuse
+
+    Free ports are kept in a queue, released ports go to its back so that a port
+    is not reused right after it was freed. Ports that are in use on the host by
+    something else are skipped and retried later.
+    """
+
+    def __init__(
+        self,
+        start: int = JUPYTER_PORT_RANGE_START,
+        end: int = JUPYTER_PORT_RANGE_END,
+        probe_host: bool = True,
+    ):
+        assert 0 < start <= end < 65536
+        self._free: Deque[int] = deque(range(start, end + 1))
+        self._allocated: Set[int] = set()
+        self._probe_host = probe_host
+
+    @property
+    def allocated(self) -> Set[int]:
+        return set(self._allocated)
+
+    def allocate(self) -> int:
+        for _ in range(len(self._free)):
+            port = self._free.popleft()
+            if self._probe_host and not is_host_port_free(port):
+                logger.info(f"Port {port} is in use on the host, skipping it")
+                self._free.append(port)
+                continue
+            self._allocated.add(port)
+            return port
+
+        raise RuntimeError("No free port left in the configured port range")
+
+    def reserve(self, n_ports: int) -> List[int]:
+        """Allocate several ports at once, either all of them or none"""
+        ports = []
+        try:
+            for _ in range(n_ports):
+                ports.append(self.allocate())
+        except RuntimeError:
+            for port in ports:
+                self.release(port)
+            raise
+        return ports
+
+    def release(self, port: int) -> None:
+        if port not in self._allocated:
+            logger.warning(f"Port {port} was not allocated, ignoring its release")
+            return
+        self._allocated.remove(port)
+        self._free.append(port)
+
+
+def is_host_port_free(port: int) -> bool:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        try:
+            sock.bind(("0.0.0.0", port))
+        except OSError:
+            return False
+    return True
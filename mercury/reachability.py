@@ -0,0 +1,134 @@
+import logging
+from collections import deque
+from typing import Dict, Iterable, List, Set
+
+logger = logging.getLogger(__name__)
+
+
+class ReachabilityIndex:
+    """Transitive closure of a DAG, kept as one ancestor and one descendant bitset
+    per node.
+
+    Every node is given a bit position, and the ancestors and descendants of a node
+    are stored as python ints with those bits set. Adding an edge updates the
+    closure by or-ing bitsets, removing an edge recomputes it only for the nodes
+    whose reachability could have changed.
+    """
+
+    def __init__(self):
+        self._bits: Dict[str, int] = {}
+        self._ids_by_bit: Dict[int, str] = {}
+        self._free_bits: List[int] = []
+        self._all_bits: int = 0
+
+        self._succ: Dict[str, Set[str]] = {}
+        self._pred: Dict[str, Set[str]] = {}
+        self._ancestors: Dict[str, int] = {}
+        self._descendants: Dict[str, int] = {}
+
+    def add_node(self, node_id: str) -> None:
+        assert node_id not in self._bits
+        bit = self._free_bits.pop() if self._free_bits else len(self._bits)
+        self._bits[node_id] = bit
+        self._ids_by_bit[bit] = node_id
+        self._all_bits |= 1 << bit
+
+        self._succ[node_id] = set()
+        self._pred[node_id] = set()
+        self._ancestors[node_id] = 0
+        self._descendants[node_id] = 0
+
+    def remove_node(self, node_id: str) -> None:
+        for dest_id in list(self._succ[node_id]):
+            self.remove_edge(node_id, dest_id)
+        for source_id in list(self._pred[node_id]):
+            self.remove_edge(source_id, node_id)
+
+        bit = self._bits.pop(node_id)
+        del self._ids_by_bit[bit]
+        self._free_bits.append(bit)
+        self._all_bits &= ~(1 << bit)
+
+        del self._succ[node_id]
+        del self._pred[node_id]
+        del self._ancestors[node_id]
+        del self._descendants[node_id]
+
+    def creates_cycle(self, source_id: str, dest_id: str) -> bool:
+        """Whether adding the edge source -> destination would create a cycle"""
+        if source_id == dest_id:
+            return True
+        return bool(self._descendants[dest_id] & self._mask(source_id))
+
+    def add_edge(self, source_id: str, dest_id: str) -> None:
+        assert not self.creates_cycle(source_id, dest_id)
+        self._succ[source_id].add(dest_id)
+        self._pred[dest_id].add(source_id)
+
+        # everything that reaches the source now reaches everything the
+        # destination reaches, and vice versa
+        upstream = self._ancestors[source_id] | self._mask(source_id)
+        downstream = self._descendants[dest_id] | self._mask(dest_id)
+        for node_id in self._ids(upstream):
+            self._descendants[node_id] |= downstream
+        for node_id in self._ids(downstream):
+            self._ancestors[node_id] |= upstream
+
+    def remove_edge(self, source_id: str, dest_id: str) -> None:
+        upstream = self._ancestors[source_id] | self._mask(source_id)
+        downstream = self._descendants[dest_id] | self._mask(dest_id)
+        self._succ[source_id].discard(dest_id)
+        self._pred[dest_id].discard(source_id)
+
+        # only nodes upstream of the edge can lose descendants and only nodes
+        # downstream of it can lose ancestors
+        for node_id in reversed(self._topological_order(self._ids(upstream))):
+            descendants = 0
+            for succ_id in self._succ[node_id]:
+                descendants |= self._mask(succ_id) | self._descendants[succ_id]
+            self._descendants[node_id] = descendants
+
+        for node_id in self._topological_order(self._ids(downstream)):
+            ancestors = 0
+            for pred_id in self._pred[node_id]:
+                ancestors |= self._mask(pred_id) | self._ancestors[pred_id]
+            self._ancestors[node_id] = ancestors
+
+    def ancestors(self, node_id: str) -> List[str]:
+        return self._ids(self._ancestors[node_id])
+
+    def descendants(self, node_id: str) -> List[str]:
+        return self._ids(self._descendants[node_id])
+
+    def valid_destinations(self, node_id: str) -> List[str]:
+        """Nodes that an edge from this node can point to without creating a cycle"""
+        invalid = self._ancestors[node_id] | self._mask(node_id)
+        return self._ids(self._all_bits & ~invalid)
+
+    def _mask(self, node_id: str) -> int:
+        return 1 << self._bits[node_id]
+
+    def _ids(self, mask: int) -> List[str]:
+        node_ids = []
+        while mask:
+            lowest = mask & -mask
+            node_ids.append(self._ids_by_bit[lowest.bit_length() - 1])
+            mask ^= lowest
+        return node_ids
+
+    def _topological_order(self, node_ids: Iterable[str]) -> List[str]:
+        node_ids = set(node_ids)
+        in_degree = {
+            node_id: len(self._pred[node_id] & node_ids) for node_id in node_ids
+        }
+        ready = deque(node_id for node_id, degree in in_degree.items() if degree == 0)
+
+        order = []
+        while ready:
+            node_id = ready.popleft()
+            order.append(node_id)
+            for succ_id in self._succ[node_id] & node_ids:
+                in_degree[succ_id] -= 1
+                if in_degree[succ_id] == 0:
+                    ready.append(succ_id)
+        return order
@@ -0,0 +1,113 @@
+import logging
+from typing import Dict, Tuple, Union
+
+from mercury.docker_client import docker_cl, run_docker_call
+
+logger = logging.getLogger(__name__)
+
+# cfs scheduler period, cpu limits are set as a quota of it
+CPU_PERIOD = 100000
+
+MEMORY_UNITS = {"b": 1, "k": 1024, "m": 1024**2, "g": 1024**3}
+
+
+def parse_cpus(cpus: Union[int, float]) -> float:
+    if cpus is None:
+        return None
+    assert isinstance(cpus, (int, float)) and not isinstance(cpus, bool)
+    assert cpus > 0
+    return float(cpus)
+
+
+def parse_memory(memory: Union[int, float, str]) -> int:
+    """Bytes of a memory amount given as bytes or as a docker string like `512m`"""
+    if memory is None:
+        return None
+    assert not isinstance(memory, bool)
+    if isinstance(memory, (int, float)):
+        # json numbers like 2.5e9 are decoded as floats
+        memory = int(memory)
+        assert memory > 0
+        return memory
+    assert isinstance(memory, str)
+    memory = memory.strip().lower()
+    # docker also takes the two letter suffixes, e.g. `2gb`
+    if len(memory) > 2 and memory[-1] == "b" and memory[-2] in MEMORY_UNITS:
+        memory = memory[:-1]
+    assert memory
+    unit = 1
+    if memory[-1] in MEMORY_UNITS:
+        memory, unit = memory[:-1], MEMORY_UNITS[memory[-1]]
+    try:
+        memory = int(float(memory) * unit)
+    except ValueError:
+        raise AssertionError(f"invalid memory amount {memory!r}")
+    assert memory > 0
+    return memory
+
+
+def get_docker_limits(cpus: float = None, memory: int = None) -> dict:
+    """Container create/update arguments limiting it to the given cpus and memory
+
+    cpu limits are given as a cfs quota rather than nano_cpus, as docker cannot
+    update the nano cpus of a running container, e.g. of a pooled one.
+    """
+    limits = {}
+    if cpus is not None:
+        assert cpus > 0
+        limits["cpu_period"] = CPU_PERIOD
+        limits["cpu_quota"] = int(cpus * CPU_PERIOD)
+    if memory is not None:
+        assert memory > 0
+        # no swap on top of the limit, nodes past it are oom killed
+        limits["mem_limit"] = memory
+        limits["memswap_limit"] = memory
+    return limits
+
+
+class HostCapacity:
+    """cpus and memory of the docker host, and how much of it running nodes use
+
+    Nodes without requests do not count against the capacity. A node requesting
+    more than the host has is treated as requesting all of it, so that it still
+    runs, alone.
+    """
+
+    def __init__(self, cpus: float, memory: int):
+        self._cpus = cpus
+        self._memory = memory
+        self._acquired: Dict[str, Tuple[float, int]] = {}
+
+    @property
+    def cpus(self) -> float:
+        return self._cpus
+
+    @property
+    def memory(self) -> int:
+        return self._memory
+
+    @property
+    def free(self) -> Tuple[float, int]:
+        used_cpus = sum(cpus for cpus, _ in self._acquired.values())
+        used_memory = sum(memory for _, memory in self._acquired.values())
+        return self._cpus - used_cpus, self._memory - used_memory
+
+    def acquire(self, owner_id: str, cpus: float = None, memory: int = None) -> bool:
+        """Reserve capacity for a node, False if it does not fit right now"""
+        cpus = min(cpus or 0.0, self._cpus)
+        memory = min(memory or 0, self._memory)
+        free_cpus, free_memory = self.free
+        # tolerance for the rounding of fractional cpus
+        if cpus > free_cpus + 1e-9 or memory > free_memory:
+            return False
+        self._acquired[owner_id] = (cpus, memory)
+        return True
+
+    def release(self, owner_id: str) -> None:
+        self._acquired.pop(owner_id, None)
+
+
+async def get_host_capacity() -> HostCapacity:
+    info = await run_docker_call(docker_cl.info)
+    logger.info(f"Docker host has {info['NCPU']} cpus and {info['MemTotal']} bytes")
+    return HostCapacity(info["NCPU"], info["MemTotal"])
@@ -0,0 +1,220 @@
+import logging
+import time
+from typing import Callable, Dict, List, Tuple
+from uuid import uuid4
+
+logger = logging.getLogger(__name__)
+
+RUN_STATE_QUEUED = "queued"
+RUN_STATE_RUNNING = "running"
+RUN_STATE_SUCCEEDED = "succeeded"
+RUN_STATE_FAILED = "failed"
+RUN_STATE_STOPPED = "stopped"
+
+NODE_STATE_PENDING = "pending"
+NODE_STATE_QUEUED = "queued"
+NODE_STATE_RUNNING = "running"
+NODE_STATE_RETRYING = "retrying"
+NODE_STATE_SUCCEEDED = "succeeded"
+NODE_STATE_SKIPPED = "skipped"
+NODE_STATE_FAILED = "failed"
+NODE_STATE_STOPPED = "stopped"
+
+
+class WorkflowRun:
+    """Status and timings of one workflow run and of each node it executes
+
+    Every change is also sent as an event to the listeners of the run, e.g.
+    `{"event": "node_started", "run_id": ..., "node_id": ..., "time": ...}`.
+    """
+
+    def __init__(
+        self,
+        workflow_id: str,
+        node_ids: List[str],
+        run_mode: str,
+        listeners: List[Callable[[dict], None]] = None,
+        edges: List[Tuple[str, str]] = None,
+        resumed_from: str = None,
+    ):
+        self.id = uuid4().hex
+        self._workflow_id = workflow_id
+        self._run_mode = run_mode
+        self._state = RUN_STATE_QUEUED
+        self._exit_code = -1
+        self._created_at = time.time()
+        self._started_at: float = None
+        self._ended_at: float = None
+        self._listeners = [] if listeners is None else list(listeners)
+        # (source node id, destination node id) of the edges between run nodes
+        self._edges = [] if edges is None else list(edges)
+        # id of the failed run whose completed nodes this run does not execute
+        self._resumed_from = resumed_from
+        # payload stamps of the output edges of every node completed in the run
+        self._checkpoints: Dict[str, Dict[str, tuple]] = {}
+
+        self._node_runs: Dict[str, dict] = {
+            node_id: {
+                "state": NODE_STATE_PENDING,
+                "queued_at": None,
+                "started_at": None,
+                "ended_at": None,
+                "exit_code": -1,
+                "container_id": None,
+                "input_bytes": None,
+                "attempts": 0,
+            }
+            for node_id in node_ids
+        }
+
+    @property
+    def workflow_id(self) -> str:
+        return self._workflow_id
+
+    @property
+    def run_mode(self) -> str:
+        return self._run_mode
+
+    @property
+    def edges(self) -> List[Tuple[str, str]]:
+        return self._edges
+
+    @property
+    def resumed_from(self) -> str:
+        return self._resumed_from
+
+    @property
+    def checkpoints(self) -> Dict[str, Dict[str, tuple]]:
+        return self._checkpoints
+
+    @property
+    def state(self) -> str:
+        return self._state
+
+    @property
+    def exit_code(self) -> int:
+        return self._exit_code
+
+    @property
+    def is_finished(self) -> bool:
+        return self._ended_at is not None
+
+    @property
+    def node_runs(self) -> Dict[str, dict]:
+        return self._node_runs
+
+    def add_listener(self, listener: Callable[[dict], None]) -> None:
+        self._listeners.append(listener)
+
+    def started(self) -> None:
+        self._state = RUN_STATE_RUNNING
+        self._started_at = time.time()
+        self._emit("run_started", time=self._started_at)
+
+    def finished(self, exit_code: int, stopped: bool = False) -> None:
+        self._exit_code = exit_code
+        if stopped:
+            self._state = RUN_STATE_STOPPED
+        elif exit_code == 0:
+            self._state = RUN_STATE_SUCCEEDED
+        else:
+            self._state = RUN_STATE_FAILED
+        self._ended_at = time.time()
+        self._emit(
+            "run_finished",
+            time=self._ended_at,
+            state=self._state,
+            exit_code=self._exit_code,
+        )
+
+    def node_queued(self, node_id: str) -> None:
+        self._update_node(node_id, "node_queued", NODE_STATE_QUEUED, "queued_at")
+
+    def node_started(
+        self, node_id: str, container_id: str = None, input_bytes: int = None
+    ) -> None:
+        self._node_runs[node_id]["container_id"] = container_id
+        self._node_runs[node_id]["attempts"] += 1
+        self._node_runs[node_id]["input_bytes"] = input_bytes
+        self._update_node(
+            node_id,
+            "node_started",
+            NODE_STATE_RUNNING,
+            "started_at",
+            container_id=container_id,
+            input_bytes=input_bytes,
+        )
+
+    def node_finished(self, node_id: str, exit_code: int, skipped: bool = False):
+        if skipped:
+            node_state = NODE_STATE_SKIPPED
+        elif exit_code == 0:
+            node_state = NODE_STATE_SUCCEEDED
+        else:
+            node_state = NODE_STATE_FAILED
+        self._node_runs[node_id]["exit_code"] = exit_code
+        self._update_node(
+            node_id, "node_finished", node_state, "ended_at", exit_code=exit_code
+        )
+
+    def node_retrying(self, node_id: str, exit_code: int, delay: float) -> None:
+        self._node_runs[node_id]["exit_code"] = exit_code
+        self._update_node(
+            node_id,
+            "node_retrying",
+            NODE_STATE_RETRYING,
+            "ended_at",
+            exit_code=exit_code,
+            attempts=self._node_runs[node_id]["attempts"],
+            delay=delay,
+        )
+
+    def checkpoint(self, node_id: str, payload_stamps: Dict[str, tuple]) -> None:
+        """Record a completed node and the payloads it left on its output edges"""
+        self._checkpoints[node_id] = payload_stamps
+
+    def node_stopped(self, node_id: str) -> None:
+        self._node_runs[node_id]["exit_code"] = 1
+        self._update_node(node_id, "node_stopped", NODE_STATE_STOPPED, "ended_at")
+
+    def to_dict(self) -> dict:
+        return {
+            "workflow_id": self._workflow_id,
+            "run_mode": self._run_mode,
+            "resumed_from": self._resumed_from,
+            "state": self._state,
+            "exit_code": self._exit_code,
+            "created_at": self._created_at,
+            "started_at": self._started_at,
+            "ended_at": self._ended_at,
+            "edges": self._edges,
+            "nodes": {
+                node_id: {
+                    **node_run,
+                    "duration": _duration(node_run["started_at"], node_run["ended_at"]),
+                }
+                for node_id, node_run in self._node_runs.items()
+            },
+        }
+
+    def _update_node(
+        self, node_id: str, event: str, node_state: str, time_field: str, **data
+    ) -> None:
+        now = time.time()
+        self._node_runs[node_id]["state"] = node_state
+        self._node_runs[node_id][time_field] = now
+        self._emit(event, node_id=node_id, time=now, state=node_state, **data)
+
+    def _emit(self, event: str, **data) -> None:
+        message = {"event": event, "run_id": self.id, **data}
+        for listener in self._listeners:
+            try:
+                listener(message)
+            except Exception:
+                logger.exception(f"Run listener failed on {event}")
+
+
+def _duration(started_at: float, ended_at: float) -> float:
+    if started_at is None or ended_at is None:
+        return None
+    return ended_at - started_at
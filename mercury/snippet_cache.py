@@ -0,0 +1,68 @@
+import logging
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Set, Tuple
+
+from mercury.constants import SNIPPET_CACHE_MAX_BYTES
+
+logger = logging.getLogger(__name__)
+
+
+class SnippetCache:
+    """LRU cache of generated code snippets, bounded by the bytes it holds
+
+    Entries are stored under an (owner id, kind) key together with a stamp, e.g. the
+    (mtime, size) of the payload file the snippet was generated from. A lookup only
+    hits when the stamp is unchanged. All entries of an edge or node can also be
+    dropped explicitly through its id.
+    """
+
+    def __init__(self, max_bytes: int = SNIPPET_CACHE_MAX_BYTES):
+        self._max_bytes = max_bytes
+        self._n_bytes = 0
+        self._entries: "OrderedDict[Tuple[str, str], Tuple[Hashable, Any, int]]" = (
+            OrderedDict()
+        )
+        self._keys_by_owner: Dict[str, Set[Tuple[str, str]]] = {}
+
+    @property
+    def n_bytes(self) -> int:
+        return self._n_bytes
+
+    def get(self, owner_id: str, kind: str, stamp: Hashable) -> Any:
+        key = (owner_id, kind)
+        entry = self._entries.get(key)
+        if entry is None or entry[0] != stamp:
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def put(
+        self, owner_id: str, kind: str, stamp: Hashable, value: Any, n_bytes: int
+    ) -> None:
+        key = (owner_id, kind)
+        self._discard(key)
+        if n_bytes > self._max_bytes:
+            return
+
+        self._entries[key] = (stamp, value, n_bytes)
+        self._keys_by_owner.setdefault(owner_id, set()).add(key)
+        self._n_bytes += n_bytes
+        while self._n_bytes > self._max_bytes:
+            self._discard(next(iter(self._entries)))
+
+    def invalidate(self, owner_id: str) -> None:
+        for key in list(self._keys_by_owner.get(owner_id, ())):
+            self._discard(key)
+
+    def _discard(self, key: Tuple[str, str]) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self._n_bytes -= entry[2]
+        owner_keys = self._keys_by_owner[key[0]]
+        owner_keys.discard(key)
+        if not owner_keys:
+            del self._keys_by_owner[key[0]]
+
+
+snippet_cache = SnippetCache()
@@ -2,11 +2,20 @@ import tornado.web  # for handlers
 import tornado.ioloop  # for listening to port
 import logging
 
+from mercury.container import container_state_cache
 from mercury.dag import MercuryDag
 from mercury.docker_client import docker_cl
+from mercury.docker_events import DockerEventWatcher
+from mercury.pool import WarmContainerPool
+from mercury.payload import install_kernel_helpers, prepare_shm_dir
 
 from server.views import MercuryHandler
-from server.views.workflow import WorkflowHandler
+from server.views.workflow import (
+    WorkflowHandler,
+    WorkflowRunHandler,
+    WorkflowHistoryHandler,
+    WorkflowWsHandler,
+)
 from server.views.node import (
     NodeHandler,
     NodeImageHandler,
@@ -24,6 +33,12 @@ class Application(tornado.web.Application):
         # setting up a dag as an attribute of this class
         # all base classes can modify it
         self.dag = MercuryDag()
+        # containers started in advance, claimed by new nodes
+        self.container_pool = WarmContainerPool(
+            self.dag.reserve_jupyter_port, self.dag.release_jupyter_port
+        )
+        # run progress is streamed to the workflow's websockets
+        self.dag.add_run_listener(WorkflowWsHandler.broadcast)
         self.handlers = [
             (r"/", MercuryHandler),
             (r"/nodes/([^/\s]+)/image", NodeImageHandler),
@@ -31,10 +46,49 @@ class Application(tornado.web.Application):
             (r"/nodes/([^/\s]+)/ws", KernelInfoHandler),
             (r"/nodes(?:/([^/\s]+))?", NodeHandler),
             (r"/connectors(?:/([^/\s]+))?", ConnectorHandler),
+            (r"/workflows/([^/\s]+)/runs(?:/([^/\s]+))?", WorkflowRunHandler),
+            (
+                r"/workflows/([^/\s]+)/history(?:/([^/\s]+))?",
+                WorkflowHistoryHandler,
+            ),
+            (r"/workflows/([^/\s]+)/ws", WorkflowWsHandler),
             (r"/workflows(?:/([^/\s]+))?", WorkflowHandler),
         ]
         super().__init__(self.handlers, debug=True)
 
+    def on_container_state_change(
+        self, node_id: str, container_id: str, state_changes: dict
+    ) -> None:
+        node = self.dag.get_node(node_id)
+        if not node or not node.mercury_container:
+            # e.g. a pooled container, its state is checked when it is claimed
+            container_state = container_state_cache.get_cached(container_id)
+            container_state_cache.update(
+                container_id, {**container_state, **state_changes}
+            )
+            return
+        if node.mercury_container.container_id != container_id:
+            return
+
+        container_state = node.mercury_container.update_container_state(state_changes)
+        if state_changes.get("Status") in ("exited", "removed"):
+            # nothing else would end the wait for a notebook run without timeout
+            node.mercury_container.container_exited()
+        KernelInfoHandler.write_to_node(
+            node_id,
+            {
+                "id": node_id,
+                "type": KernelInfoHandler.json_type,
+                "attributes": {
+                    "container_attributes": {
+                        "id": container_id,
+                        "state": container_state.get("Status"),
+                        "oom_killed": container_state.get("OOMKilled", False),
+                    }
+                },
+            },
+        )
+
 
 if __name__ == "__main__":
     # kill all running mercury containers
@@ -45,8 +99,18 @@ if __name__ == "__main__":
         if "jupyter-mercury:latest" in _.image.tags
     ]
 
+    # modules imported by the code snippets that move data between nodes
+    install_kernel_helpers()
+    prepare_shm_dir()
+
     app = Application()
 
+    # container state changes are pushed to the nodes' websockets as they happen
+    docker_event_watcher = DockerEventWatcher(app.on_container_state_change)
+    docker_event_watcher.start()
+
+    tornado.ioloop.IOLoop.current().add_callback(app.container_pool.refill)
+
     app.listen(8888)
     logging.info("Running on port 8888")
     tornado.ioloop.IOLoop.current().start()
@@ -3,6 +3,7 @@ import logging
 from uuid import uuid4
 
 from mercury.edge import MercuryEdge
+from mercury.payload import DEFAULT_PAYLOAD_FORMAT, PAYLOAD_FORMATS
 
 from server.views import MercuryHandler
 
@@ -17,16 +18,9 @@ class ConnectorHandler(MercuryHandler):
         # only work for a particular connector id for now
         assert connector_id
 
-        connector_edge = None
-        for _e in self.application.dag.edges:
-
-            for _c in _e.source_dest_connect:
-                if _c["connector_id"] == connector_id:
-                    connector_edge = _e
-                    source_dest_map = _c
-                    break
-            break
-
+        connector_edge, source_dest_map = self.application.dag.get_connector(
+            connector_id
+        )
         assert connector_edge, "This connector does not exist for any edge"
 
         data = {
@@ -41,6 +35,7 @@ class ConnectorHandler(MercuryHandler):
                     **source_dest_map["destination"],
                     "node_id": connector_edge.dest_node.id,
                 },
+                "payload_format": connector_edge.payload_format,
             },
         }
 
@@ -91,7 +86,10 @@ class ConnectorHandler(MercuryHandler):
         )
 
         if not edge:
-            edge = MercuryEdge(source_node, dest_node)
+            # the payload format can only be chosen by the first connector of an edge
+            payload_format = attr_data.get("payload_format", DEFAULT_PAYLOAD_FORMAT)
+            assert payload_format in PAYLOAD_FORMATS
+            edge = MercuryEdge(source_node, dest_node, payload_format=payload_format)
             self.application.dag.add_edge(edge)
 
         source_dest_map = {
@@ -100,7 +98,7 @@ class ConnectorHandler(MercuryHandler):
             "connector_id": uuid4().hex,
         }
 
-        edge.source_dest_connect.append(source_dest_map)
+        self.application.dag.add_connector(edge, source_dest_map)
 
         data = {
             "id": source_dest_map["connector_id"],
@@ -111,6 +109,7 @@ class ConnectorHandler(MercuryHandler):
                     **source_dest_map["destination"],
                     "node_id": edge.dest_node.id,
                 },
+                "payload_format": edge.payload_format,
             },
         }
 
@@ -123,23 +122,12 @@ class ConnectorHandler(MercuryHandler):
         # only work for a particular connector id for now
         assert connector_id
 
-        connector_edge = None
-        for _e in self.application.dag.edges:
-
-            for del_i, _c in enumerate(_e.source_dest_connect):
-                if _c["connector_id"] == connector_id:
-                    connector_edge = _e
-                    break
-            break
-
-        assert connector_edge, "This connector does not exist for any edge"
-
-        connector_edge.source_dest_connect.pop(del_i)
+        assert (
+            connector_id in self.application.dag.connectors
+        ), "This connector does not exist for any edge"
 
-        # Delete an edge if all connectors related to an edge
-        # have been deleted
-        if len(connector_edge.source_dest_connect) == 0:
-            self.application.dag.remove_edge(connector_edge)
+        # the edge is deleted as well if this was its last connector
+        self.application.dag.remove_connector(connector_id)
 
         self.set_status(204)
         self.set_header("Content-Type", "application/vnd.api+json")
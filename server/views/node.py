@@ -4,11 +4,12 @@ import logging
 from tornado.websocket import WebSocketClosedError
 
 from mercury.node import MercuryNode
+from mercury.container import container_state_cache
 
 from server.views import MercuryHandler, MercuryWsHandler
 from server.views.utils import (
     get_node_attrs,
-    get_node_input_code_snippet,
+    get_node_io_attrs,
     get_node_output_code_snippet,
 )
 
@@ -21,7 +22,7 @@ class NodeHandler(MercuryHandler):
     # decorator to wrap and create a json api response, wrap in data, attributes, types
     json_type = "nodes"
 
-    def get(self, node_id=None):
+    async def get(self, node_id=None):
         """Returns the node(s) available
         ---
         tags: [Nodes]
@@ -49,6 +50,7 @@ class NodeHandler(MercuryHandler):
         else:
             nodes = self.application.dag.nodes
 
+        await container_state_cache.ensure_fresh()
         data = []
 
         for node in nodes:
@@ -60,15 +62,9 @@ class NodeHandler(MercuryHandler):
 
             edges = self.application.dag.get_node_edges(node.id)
             logger.info(f"edges for this node: {len(edges)}")
-            input_code = get_node_input_code_snippet(node, edges)
-            output_code = get_node_output_code_snippet(node, edges)
-
-            node_response["attributes"]["notebook_attributes"]["io"][
-                "input_code"
-            ] = input_code
-            node_response["attributes"]["notebook_attributes"]["io"][
-                "output_code"
-            ] = output_code
+            node_response["attributes"]["notebook_attributes"][
+                "io"
+            ] = get_node_io_attrs(node, edges)
             data.append(node_response)
 
         self.set_status(200)
@@ -76,7 +72,7 @@ class NodeHandler(MercuryHandler):
         self.set_header("Content-Type", "application/vnd.api+json")
 
     # _ parameter added as post expects two arguments from route
-    def post(self, _):
+    async def post(self, _):
         """Creates a new node and runs its container
         ---
         tags: [Nodes]
@@ -102,13 +98,26 @@ class NodeHandler(MercuryHandler):
                                 NoSchema
         """
         data = json.loads(self.request.body)
-        node = MercuryNode(**data.get("attributes", {}))
 
-        # add the node to the dag first, as this sets the jupyter port
-        self.application.dag.add_node(node)
+        pooled = self.application.container_pool.claim()
+        if pooled:
+            # the pooled container was started with this node id and port
+            node = MercuryNode(**data.get("attributes", {}), node_id=pooled.node_id)
+            node.jupyter_port = pooled.jupyter_port
+            node.attach_container(pooled.container)
+            self.application.dag.add_node(node)
+            # pooled containers are started without limits
+            if node.cpus is not None or node.memory is not None:
+                await node.set_resources(node.cpus, node.memory)
+        else:
+            node = MercuryNode(**data.get("attributes", {}))
+
+            # add the node to the dag first, as this sets the jupyter port
+            self.application.dag.add_node(node)
 
-        node.initialise_container()
+            await node.initialise_container()
 
+        await container_state_cache.ensure_fresh(node.mercury_container.container_id)
         data = {
             "id": node.id,
             "type": self.json_type,
@@ -120,7 +129,7 @@ class NodeHandler(MercuryHandler):
         self.write({"data": data})
         self.set_header("Content-Type", "application/vnd.api+json")
 
-    def patch(self, node_id):
+    async def patch(self, node_id):
         """Updates properties of a node
         ---
         tags: [Nodes]
@@ -148,6 +157,17 @@ class NodeHandler(MercuryHandler):
         node.input = data["data"].get("attributes", {}).get("input", node.input)
         node.output = data["data"].get("attributes", {}).get("output", node.output)
 
+        attributes = data["data"].get("attributes", {})
+        node.timeout = attributes.get("timeout", node.timeout)
+        node.retries = attributes.get("retries", node.retries)
+        node.retry_backoff = attributes.get("retry_backoff", node.retry_backoff)
+        if "cpus" in attributes or "memory" in attributes:
+            await node.set_resources(
+                attributes.get("cpus", node.cpus),
+                attributes.get("memory", node.memory),
+            )
+
+        await container_state_cache.ensure_fresh()
         data = {
             "id": node.id,
             "type": self.json_type,
@@ -155,10 +175,7 @@ class NodeHandler(MercuryHandler):
         }
 
         edges = self.application.dag.get_node_edges(node.id)
-        input_code = get_node_input_code_snippet(node, edges)
-        output_code = get_node_output_code_snippet(node, edges)
-        data["attributes"]["notebook_attributes"]["io"]["input_code"] = input_code
-        data["attributes"]["notebook_attributes"]["io"]["output_code"] = output_code
+        data["attributes"]["notebook_attributes"]["io"] = get_node_io_attrs(node, edges)
 
         self.set_status(200)
         self.write({"data": data})
@@ -166,7 +183,7 @@ class NodeHandler(MercuryHandler):
 
         # to do: updation for other properties
 
-    def delete(self, node_id):
+    async def delete(self, node_id):
         """Deletes the node
         ---
         tags: [Nodes]
@@ -189,7 +206,7 @@ class NodeHandler(MercuryHandler):
                                 NoSchema
         """
         node = self.application.dag.get_node(node_id)
-        node.mercury_container.container.kill()
+        await node.kill()
         self.application.dag.remove_node(node)
 
         self.set_status(204)
@@ -201,7 +218,7 @@ class NodeHandler(MercuryHandler):
 class NodeImageHandler(MercuryHandler):
     json_type = "nodes"
 
-    def patch(self, node_id):
+    async def patch(self, node_id):
         data = json.loads(self.request.body)
         node = self.application.dag.get_node(node_id)
 
@@ -214,7 +231,9 @@ class NodeImageHandler(MercuryHandler):
         assert change_state in ["build"]
 
         if change_state == "build":
-            node.commit()
+            await node.commit()
+
+        await container_state_cache.ensure_fresh()
 
         data = {
             "id": node.id,
@@ -223,8 +242,7 @@ class NodeImageHandler(MercuryHandler):
         }
 
         edges = self.application.dag.get_node_edges(node.id)
-        code = get_node_input_code_snippet(node, edges)
-        data["attributes"]["notebook_attributes"]["io"]["input_code"] = code
+        data["attributes"]["notebook_attributes"]["io"] = get_node_io_attrs(node, edges)
 
         self.set_status(200)
         self.write({"data": data})
@@ -255,6 +273,7 @@ class NodeNotebookHandler(MercuryHandler):
             ]
         )
 
+        await container_state_cache.ensure_fresh()
         response_data = {
             "id": node.id,
             "type": self.json_type,
@@ -262,14 +281,9 @@ class NodeNotebookHandler(MercuryHandler):
         }
 
         edges = self.application.dag.get_node_edges(node.id)
-        input_code = get_node_input_code_snippet(node, edges)
-        output_code = get_node_output_code_snippet(node, edges)
-        response_data["attributes"]["notebook_attributes"]["io"][
-            "input_code"
-        ] = input_code
-        response_data["attributes"]["notebook_attributes"]["io"][
-            "output_code"
-        ] = output_code
+        response_data["attributes"]["notebook_attributes"]["io"] = get_node_io_attrs(
+            node, edges
+        )
 
         if "state" in data["data"]["attributes"]:
 
@@ -279,30 +293,18 @@ class NodeNotebookHandler(MercuryHandler):
             if change_state == "run":
                 assert "code" in data["data"].get("attributes")
                 code = data["data"]["attributes"]["code"]
-                exit_code, container_output = node.execute_code(code)
+                exit_code, container_output = await node.execute_code(code)
 
             if change_state == "write_json":
                 edges = self.application.dag.get_node_edges(node.id)
                 container_output = "".encode()
                 exit_code = -1
-                if not edges:
-                    logger.warning("This node does not have any edges")
-                for edge in edges:
-                    if edge.source_node != node:
-                        continue
-                    # variables that have to be written as keys in json
-                    dest_inputs = [
-                        _["destination"]["input"] for _ in edge.source_dest_connect
-                    ]
-                    # variables for which we need to get values from within the kernel
-                    source_outputs = [
-                        _["source"]["output"] for _ in edge.source_dest_connect
-                    ]
-                    logger.info(f"writing for edge {edge.id}")
-                    exit_code, container_output = node.write_output_to_json(
-                        source_outputs,
-                        dest_inputs,
-                        edge.json_path_container,
+                if not any(edge.source_node == node for edge in edges):
+                    logger.warning("This node does not have any outgoing edges")
+                else:
+                    # the payloads of all outgoing edges are written at once
+                    exit_code, container_output = await node.execute_code(
+                        get_node_output_code_snippet(node, edges)
                     )
 
             response_data["attributes"]["notebook_attributes"][
@@ -318,12 +320,7 @@ class NodeNotebookHandler(MercuryHandler):
             ] = kernel_state
 
             # write to websocket here if a websocket is open and instantialised
-            if node_id in KernelInfoHandler.instances:
-                try:
-                    logger.info(f"sending message to websocket for node {node_id}")
-                    KernelInfoHandler.instances[node_id].write_message(response_data)
-                except WebSocketClosedError as e:
-                    logger.warning("tried writing to websocket but it is closed")
+            KernelInfoHandler.write_to_node(node_id, response_data)
 
         if "workflow_kernel_state" in data["data"]["attributes"]:
             workflow_kernel_state = data["data"]["attributes"].get(
@@ -335,12 +332,7 @@ class NodeNotebookHandler(MercuryHandler):
             ] = workflow_kernel_state
 
             # write to websocket here if a websocket is open and instantialised
-            if node_id in KernelInfoHandler.instances:
-                try:
-                    logger.info(f"sending message to websocket for node {node_id}")
-                    KernelInfoHandler.instances[node_id].write_message(response_data)
-                except WebSocketClosedError as e:
-                    logger.warning("tried writing to websocket but it is closed")
+            KernelInfoHandler.write_to_node(node_id, response_data)
 
         if "notebook_exec_exit_code" in data["data"]["attributes"]:
             exit_code = data["data"]["attributes"]["notebook_exec_exit_code"]
@@ -364,12 +356,7 @@ class NodeNotebookHandler(MercuryHandler):
             ] = jupyter_server_state
 
             # write to websocket here if a websocket is open and instantialised
-            if node_id in KernelInfoHandler.instances:
-                try:
-                    logger.info(f"sending message to websocket for node {node_id}")
-                    KernelInfoHandler.instances[node_id].write_message(response_data)
-                except WebSocketClosedError as e:
-                    logger.warning("tried writing to websocket but it is closed")
+            KernelInfoHandler.write_to_node(node_id, response_data)
 
         self.set_status(200)
         response_data_resource = {
@@ -392,6 +379,16 @@ class KernelInfoHandler(MercuryWsHandler):
         else:
             self.close(code=403, reason="tried connecting to a node that doesn't exist")
 
+    @classmethod
+    def write_to_node(cls, node_id: str, message: dict) -> None:
+        if node_id not in cls.instances:
+            return
+        try:
+            logger.info(f"sending message to websocket for node {node_id}")
+            cls.instances[node_id].write_message(message)
+        except WebSocketClosedError as e:
+            logger.warning("tried writing to websocket but it is closed")
+
     def on_close(self):
         del_node_id = self.request.uri.split("/")[2]
         if del_node_id in KernelInfoHandler.instances:
@@ -2,8 +2,10 @@ from typing import List
 import logging
 
 from mercury.node import MercuryNode
-from mercury.edge import MercuryEdge
+from mercury.edge import MercuryEdge, get_export_code_snippet
 from mercury.dag import MercuryDag
+from mercury.snippet_cache import snippet_cache
+from mercury.constants import NOTEBOOK_PATH
 
 logger = logging.getLogger(__name__)
 
@@ -12,48 +14,108 @@ INPUT_CODE_SNIPPET_HEADER = "# Mercury-Input\n"
 
 
 def get_node_input_code_snippet(node: MercuryNode, edges: List[MercuryEdge]) -> str:
+    input_edges = [edge for edge in edges if edge.dest_node == node]
+
+    # unchanged payloads are only stat-ed, not read again
+    snippet_stamp = (
+        tuple(node.input or ()),
+        tuple((edge.id, edge.get_payload_stamp()) for edge in input_edges),
+    )
+    cached = snippet_cache.get(node.id, "input", snippet_stamp)
+    if cached is not None:
+        return cached
 
     code_lines = []
-    inputs_available_in_json = []
-    for edge in edges:
-        if edge.dest_node != node:
-            continue
+    inputs_available_in_payload = []
+    for edge in input_edges:
         snippet = edge.get_input_code_snippet()
         if not snippet:
             continue
         snippet = f"\n#from source node {edge.source_node.id}\n" + snippet + "\n"
-        inputs_available_in_json += edge.json_inputs
+        inputs_available_in_payload += edge.payload_inputs
         code_lines.append(snippet)
 
     if node.input:
         for input_name in node.input:
             # to do: check kernel type running in container
-            if input_name not in inputs_available_in_json:
+            if input_name not in inputs_available_in_payload:
                 snippet = f"{input_name} = None\n"
                 code_lines.append(snippet)
 
     code = "".join(code_lines)
     code = INPUT_CODE_SNIPPET_HEADER + code
+    snippet_cache.put(node.id, "input", snippet_stamp, code, len(code))
     return code
 
 
 def get_node_output_code_snippet(node: MercuryNode, edges: List[MercuryEdge]) -> str:
-    code_lines = []
-    for edge in edges:
-        if edge.source_node != node:
-            continue
-        snippet = edge.get_output_code_snippet()
-        snippet = f"\n# for destination node {edge.dest_node.id}\n" + snippet
-        code_lines.append(snippet)
+    output_edges = [edge for edge in edges if edge.source_node == node]
 
-    if len(code_lines) == 0:
-        code_lines.append("# Create a connector for this node to export outputs")
+    snippet_stamp = tuple(
+        (edge.id, len(edge.source_dest_connect)) for edge in output_edges
+    )
+    cached = snippet_cache.get(node.id, "output", snippet_stamp)
+    if cached is not None:
+        return cached
+
+    if output_edges:
+        # all the outgoing edges are written by one call in the kernel
+        code = get_export_code_snippet(output_edges)
+    else:
+        code = "# Create a connector for this node to export outputs"
 
-    code = "".join(code_lines)
     code = OUTPUT_CODE_SNIPPET_HEADER + code
+    snippet_cache.put(node.id, "output", snippet_stamp, code, len(code))
     return code
 
 
+def get_node_input_variables(node: MercuryNode, edges: List[MercuryEdge]) -> list:
+    """Metadata of the variables available to the node, without their values
+
+    Reads the payload of the input edges, call after get_node_input_code_snippet
+    to reuse what it has read.
+    """
+    input_variables = []
+    for edge in edges:
+        if edge.dest_node != node or not edge.payload_variables:
+            continue
+        for variable in edge.payload_variables:
+            input_variables.append({**variable, "source_node_id": edge.source_node.id})
+    return input_variables
+
+
+def get_node_input_payloads(node: MercuryNode, edges: List[MercuryEdge]) -> list:
+    """Bytes of the payload of each input edge, before and after compression
+
+    Call after get_node_input_code_snippet, as get_node_input_variables.
+    """
+    input_payloads = []
+    for edge in edges:
+        if edge.dest_node != node or not edge.payload_variables:
+            continue
+        input_payloads.append(
+            {
+                "edge_id": edge.id,
+                "source_node_id": edge.source_node.id,
+                "payload_format": edge.payload_format,
+                "in_shm": edge.is_payload_in_shm,
+                "size": sum(_["size"] for _ in edge.payload_variables),
+                "stored_size": sum(_["stored_size"] for _ in edge.payload_variables),
+            }
+        )
+    return input_payloads
+
+
+def get_node_io_attrs(node: MercuryNode, edges: List[MercuryEdge]) -> dict:
+    input_code = get_node_input_code_snippet(node, edges)
+    return {
+        "input_code": input_code,
+        "output_code": get_node_output_code_snippet(node, edges),
+        "inputs": get_node_input_variables(node, edges),
+        "input_payloads": get_node_input_payloads(node, edges),
+    }
+
+
 def get_node_attrs(node: MercuryNode) -> dict:
     return {
         "input": node.input,
@@ -67,8 +129,15 @@ def get_node_attrs(node: MercuryNode) -> dict:
             "id": node.mercury_container.container_id,
             "state": node.mercury_container.container_state["Status"],
         },
+        "resource_attributes": {
+            "cpus": node.cpus,
+            "memory": node.memory,
+            "timeout": node.timeout,
+            "retries": node.retries,
+            "retry_backoff": node.retry_backoff,
+        },
         "notebook_attributes": {
-            "url": f"http://localhost:{node.jupyter_port}/notebooks/work/scripts/Untitled.ipynb?kernel_name=python3",
+            "url": f"http://localhost:{node.jupyter_port}/notebooks/{NOTEBOOK_PATH}?kernel_name=python3",
             "state": None,
             "exit_code": -1,
             "container_log": None,
@@ -77,7 +146,12 @@ def get_node_attrs(node: MercuryNode) -> dict:
             "jupyter_server": node.mercury_container.jupyter_server,
             "notebook_exec_pid": None,
             "notebook_exec_exit_code": node.mercury_container.notebook_exec_exit_code,
-            "io": {"input_code": None, "output_code": None},
+            "io": {
+                "input_code": None,
+                "output_code": None,
+                "inputs": None,
+                "input_payloads": None,
+            },
         },
     }
 
@@ -85,14 +159,10 @@ def get_node_attrs(node: MercuryNode) -> dict:
 def get_workflow_attrs(dag: MercuryDag) -> dict:
     nodes = [{"id": node.id, "type": "nodes"} for node in dag.nodes]
 
-    connectors = []
-    for _e in dag.edges:
-        for _c in _e.source_dest_connect:
-            connector = {
-                "id": _c["connector_id"],
-                "type": "connectors",
-            }
-            connectors.append(connector)
+    connectors = [
+        {"id": connector_id, "type": "connectors"}
+        for connector_id in dag.connectors.connector_ids
+    ]
 
     valid_connections = dag.get_valid_connections_for_nodes()
     valid_connections = {
@@ -106,5 +176,6 @@ def get_workflow_attrs(dag: MercuryDag) -> dict:
         "valid_connections": valid_connections,
         "run_exit_code": -1,
         "state": "idle",
+        "active_run_id": dag.active_run.id if dag.active_run else None,
     }
     return attrs_data
@@ -1,7 +1,12 @@
 import logging
 import json
+from typing import Set
 
-from server.views import MercuryHandler
+from mercury.dag import RUN_MODES, RUN_MODE_ALL
+
+from tornado.websocket import WebSocketClosedError
+
+from server.views import MercuryHandler, MercuryWsHandler
 from server.views.utils import get_workflow_attrs
 
 logger = logging.getLogger(__name__)
@@ -29,12 +34,59 @@ class WorkflowHandler(MercuryHandler):
         assert "attributes" in data["data"]
         assert "state" in data["data"].get("attributes")
 
-        assert data["data"]["attributes"]["state"] in ["run", "stop"]
+        assert data["data"]["attributes"]["state"] in ["run", "resume", "stop"]
+
+        run = None
+        plan = None
+
+        if data["data"]["attributes"]["state"] in ["run", "resume"]:
+            # nodes whose inputs did not change since a previous run are skipped,
+            # unless the client asks for every node to be executed again
+            use_memo = data["data"]["attributes"].get("use_cache", True)
+
+            # seconds after which the whole run is stopped, on top of the
+            # timeouts of the individual nodes
+            timeout = data["data"]["attributes"].get("timeout")
+            assert timeout is None or timeout > 0
 
         if data["data"]["attributes"]["state"] == "run":
-            self.application.dag.state = "running"
-            exit_code = await self.application.dag.run_dag()
-            self.application.dag.state = None
+            # runs can be limited to the nodes downstream ("from") or upstream
+            # ("to") of the given nodes, or to exactly the given nodes ("subset")
+            run_mode = data["data"]["attributes"].get("run_mode", RUN_MODE_ALL)
+            assert run_mode in RUN_MODES
+            node_ids = data["data"]["attributes"].get("node_ids")
+
+            if data["data"]["attributes"].get("dry_run", False):
+                # the predicted schedule of the run, nothing is executed
+                plan = await self.application.dag.plan_run(
+                    run_mode=run_mode, node_ids=node_ids
+                )
+                exit_code = -1
+            else:
+                run = self.application.dag.start_run(
+                    run_mode=run_mode,
+                    node_ids=node_ids,
+                    use_memo=use_memo,
+                    timeout=timeout,
+                )
+
+        if data["data"]["attributes"]["state"] == "resume":
+            # continues a failed or stopped run, by default the latest one,
+            # without executing again the nodes it completed
+            run = self.application.dag.resume_run(
+                run_id=data["data"]["attributes"].get("run_id"),
+                use_memo=use_memo,
+                timeout=timeout,
+            )
+
+        if run is not None:
+            # the run goes on in the background, its progress can be polled
+            # from the run resource or followed on the workflow's websocket
+            exit_code = run.exit_code
+            self.set_status(202)
+            self.set_header(
+                "Location", f"/workflows/{self.application.dag.id}/runs/{run.id}"
+            )
 
         if data["data"]["attributes"]["state"] == "stop":
             logger.info("received stop signal")
@@ -47,5 +99,90 @@ class WorkflowHandler(MercuryHandler):
             "attributes": get_workflow_attrs(self.application.dag),
         }
         response["attributes"]["run_exit_code"] = exit_code
+        if plan is not None:
+            response["attributes"]["plan"] = plan
+        if run is not None:
+            response["attributes"]["run_id"] = run.id
         self.write({"data": response})
         self.set_header("Content-Type", "application/vnd.api+json")
+
+
+class WorkflowRunHandler(MercuryHandler):
+    json_type = "runs"
+
+    def get(self, workflow_id, run_id=None):
+        assert workflow_id == self.application.dag.id
+        if run_id:
+            run = self.application.dag.get_run(run_id)
+            if run is None:
+                self.set_status(404)
+                self.write({"errors": [{"detail": f"Run {run_id} does not exist"}]})
+                return
+            runs = [run]
+        else:
+            runs = self.application.dag.runs
+
+        data = [
+            {"id": run.id, "type": self.json_type, "attributes": run.to_dict()}
+            for run in runs
+        ]
+
+        self.set_status(200)
+        self.write({"data": data[0] if run_id else data})
+        self.set_header("Content-Type", "application/vnd.api+json")
+
+
+class WorkflowHistoryHandler(MercuryHandler):
+    """Recorded runs of the workflow, with the critical path of a single run"""
+
+    json_type = "runs"
+
+    async def get(self, workflow_id, run_id=None):
+        assert workflow_id == self.application.dag.id
+        run_history = self.application.dag.run_history
+        if run_id:
+            run = await run_history.get_run(run_id)
+            if run is None:
+                self.set_status(404)
+                self.write({"errors": [{"detail": f"Run {run_id} is not recorded"}]})
+                return
+            data = {"id": run_id, "type": self.json_type, "attributes": run}
+        else:
+            limit = int(self.get_query_argument("limit", 50))
+            data = [
+                {"id": run["run_id"], "type": self.json_type, "attributes": run}
+                for run in await run_history.list_runs(workflow_id, limit)
+            ]
+
+        self.set_status(200)
+        self.write({"data": data})
+        self.set_header("Content-Type", "application/vnd.api+json")
+
+
+class WorkflowWsHandler(MercuryWsHandler):
+    """Streams the events of the workflow's runs, e.g. nodes starting and finishing"""
+
+    instances: Set["WorkflowWsHandler"] = set()
+    json_type = "runs"
+
+    def open(self, workflow_id):
+        if workflow_id == self.application.dag.id:
+            WorkflowWsHandler.instances.add(self)
+            logger.info(f"Websocket connection opened for workflow {workflow_id}")
+        else:
+            self.close(
+                code=403, reason="tried connecting to a workflow that doesn't exist"
+            )
+
+    @classmethod
+    def broadcast(cls, event: dict) -> None:
+        message = {"id": event["run_id"], "type": cls.json_type, "attributes": event}
+        for handler in list(cls.instances):
+            try:
+                handler.write_message(message)
+            except WebSocketClosedError:
+                logger.warning("tried writing to websocket but it is closed")
+                cls.instances.discard(handler)
+
+    def on_close(self):
+        WorkflowWsHandler.instances.discard(self)